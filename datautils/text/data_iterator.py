@@ -1,9 +1,67 @@
-from random import shuffle
+import random
 import collections
+from ..utils import fork_pool, worker_config, prefetch_depth, dump_result, load_result
+
+def _batch_bounds(cache, batch_size, sort_func, max_tokens, padded_tokens):
+    # Fixed size batches, or greedy batches under a token budget where the
+    # length of a record is given by sort_func. In budget mode, batch_size
+    # still caps the number of records per batch.
+    if max_tokens is None:
+        return [(idx, idx+batch_size) for idx in range(0, len(cache), batch_size)]
+
+    bounds = []
+    start, num_tokens, max_len = 0, 0, 0
+    for idx, record in enumerate(cache):
+        length = sort_func(record)
+        if padded_tokens:
+            # padded area of the batch: max_len x batch
+            cost = max(max_len, length) * (idx - start + 1)
+        else:
+            cost = num_tokens + length
+        if idx > start and (cost > max_tokens or idx - start >= batch_size):
+            bounds.append((start, idx))
+            start, num_tokens, max_len = idx, 0, 0
+        num_tokens += length
+        max_len = max(max_len, length)
+    if start < len(cache):
+        bounds.append((start, len(cache)))
+
+    return bounds
+
+def _batch_cache(cache, batch_size, shuffle, process_func, sort_func, pack_func=None,
+                 max_tokens=None, padded_tokens=False, rng=random):
+    # Batches of the cache, packed and pickled one by one when pack_func is
+    # given (prefetch workers), record lists otherwise (packed on yield)
+
+    # processing
+    if process_func is not None:
+        cache = [process_func(record) for record in cache]
+
+    # sorting
+    if shuffle and sort_func is not None:
+        cache = sorted(cache, key = sort_func)
+
+    # batching
+    batches = [cache[start:end] for start, end in
+               _batch_bounds(cache, batch_size, sort_func, max_tokens, padded_tokens)]
+    if shuffle:
+        rng.shuffle(batches)
+
+    # packing
+    if pack_func is not None:
+        batches = [dump_result(pack_func(batch)) for batch in batches]
+
+    return batches
+
+#### Worker side of the prefetching mode, see datautils.utils.fork_pool
+def _batch_cache_worker(cache, seed):
+    return _batch_cache(cache, rng=random.Random(seed), **worker_config())
 
 class BucketIterator(object):
-    def __init__(self, dataset, batch_size, cache_size=None, shuffle=False, 
-                 process_func=None, sort_func=None, pack_func=None):
+    def __init__(self, dataset, batch_size, cache_size=None, shuffle=False,
+                 process_func=None, sort_func=None, pack_func=None,
+                 num_workers=0, num_prefetch=None, seed=None,
+                 max_tokens=None, padded_tokens=False, rank=0, world_size=1):
         self.dataset      = dataset
         self.batch_size   = batch_size
         self.shuffle      = shuffle
@@ -12,45 +70,160 @@ class BucketIterator(object):
         self.sort_func    = sort_func
         self.pack_func    = pack_func
 
+        # token budget mode: fill each batch up to max_tokens using the
+        # sort_func lengths (or max_len x batch when padded_tokens is set)
+        if max_tokens is not None and sort_func is None:
+            raise ValueError('max_tokens requires sort_func to provide record lengths')
+        self.max_tokens    = max_tokens
+        self.padded_tokens = padded_tokens
+
+        # prefetching mode: caches are processed and batched by worker processes
+        self.num_workers  = num_workers
+        self.num_prefetch = prefetch_depth(num_prefetch, num_workers)
+        self.rng          = random.Random(seed)
+
+        # data-parallel reading: every worker must pass the same seed so that
+        # the per-epoch reader seeds (drawn from data_rng) agree across ranks.
+        # Ranks of sharded readers can yield different numbers of batches
+        # (see epoch_shards), so bound data-parallel epochs by a step count;
+        # data_rng is seeded apart from rng so that their streams differ.
+        # Without a seed, a single worker still draws the reader seeds from
+        # its own data_rng, so that no reader falls back to the global RNGs.
+        self.rank         = rank
+        self.world_size   = world_size
+        if seed is not None:
+            self.data_rng = random.Random('{}-data'.format(seed))
+        else:
+            self.data_rng = random.Random() if world_size == 1 else None
+
+        self.restored      = False
+        self.end_of_epoch  = False
+        self.ready_batches = collections.deque()
+        self.ready_packed  = False
+        self.pending       = collections.deque()
+
     def reset(self):
         self.end_of_epoch = False
-        self.dataset.reset(self.shuffle)
+        if self.world_size > 1 or self.data_rng is not None:
+            data_seed = self.data_rng.getrandbits(32) if self.data_rng is not None else None
+            self.dataset.reset(self.shuffle, self.rank, self.world_size, data_seed)
+        else:
+            self.dataset.reset(self.shuffle)
+
+    def read_cache(self):
+        # Readers with next_records (LargeText, BlockCompressedText) read the
+        # whole cache in one call, in file order or on helper threads
+        if hasattr(self.dataset, 'next_records'):
+            cache = self.dataset.next_records(self.cache_size) or []
+            if len(cache) < self.cache_size:
+                self.end_of_epoch = True
+            return cache
+
+        cache = []
+        for idx in range(self.cache_size):
+            record = self.dataset.next_record()
+            if record is None:
+                self.end_of_epoch = True
+                break
+            cache.append(record)
+        return cache
+
+    def batch_config(self):
+        return dict(batch_size=self.batch_size, shuffle=self.shuffle, process_func=self.process_func,
+                    sort_func=self.sort_func, max_tokens=self.max_tokens, padded_tokens=self.padded_tokens)
+
+    def worker_config(self):
+        config = self.batch_config()
+        config['pack_func'] = self.pack_func
+        return config
+
+    def pop_batch(self):
+        # In serial mode packing happens as each batch is yielded, so a
+        # pack_func recycling num_buffers output buffers never overwrites a
+        # batch still waiting in ready_batches. Prefetch workers pickle each
+        # batch as soon as it is packed, before its buffers are reused.
+        batch = self.ready_batches.popleft()
+        if self.pack_func is not None:
+            if self.ready_packed:
+                batch = load_result(batch)
+            else:
+                batch = self.pack_func(batch)
+        return batch
+
+    def begin_epoch(self):
+        # A restored state continues the interrupted epoch instead of resetting
+        if self.restored:
+            self.restored = False
+        else:
+            self.reset()
+            self.ready_batches = collections.deque()
+        self.pending = collections.deque()
 
     def __iter__(self):
-        # reset states
-        self.reset()
+        if self.num_workers > 0:
+            return self.iter_prefetch()
+        else:
+            return self.iter_serial()
+
+    def iter_serial(self):
+        self.begin_epoch()
 
         while True:
-            # caching
-            cache = []
-            for idx in range(self.cache_size):
-                record = self.dataset.next_record()
-                if record is None:
-                    self.end_of_epoch = True
-                    break
-                if self.process_func is not None:
-                    record = self.process_func(record)
-                cache.append(record)
-
-            # sorting
-            if self.shuffle and self.sort_func is not None:
-                cache = sorted(cache, key = self.sort_func)
-            
-            # packing
-            batches = []
-            for idx in range(0, len(cache), self.batch_size):
-                batch = cache[idx:idx+self.batch_size]
-                if len(batch) == 0:
-                    print('Error', idx, len(cache))
-                if self.pack_func is not None:
-                    batch = self.pack_func(batch)
-                batches.append(batch)
-            if self.shuffle:
-                shuffle(batches)
-
-            # generate batch
-            for batch in batches:
-                yield batch
+            while len(self.ready_batches) > 0:
+                yield self.pop_batch()
 
             if self.end_of_epoch:
-                raise StopIteration
+                return
+
+            # per-cache seeds drawn as in iter_prefetch, so that a fixed seed
+            # gives the same batch order for any num_workers
+            cache = self.read_cache()
+            rng = random.Random(self.rng.getrandbits(32))
+            self.ready_batches.extend(_batch_cache(cache, rng=rng, **self.batch_config()))
+            self.ready_packed = False
+
+    def iter_prefetch(self):
+        self.begin_epoch()
+
+        with fork_pool(self.num_workers, self.worker_config()) as pool:
+            while True:
+                while len(self.ready_batches) > 0:
+                    yield self.pop_batch()
+
+                # keep at most num_prefetch caches in flight; results are
+                # consumed in submission order, so the batch order only
+                # depends on the reader order and the per-cache seeds
+                while not self.end_of_epoch and len(self.pending) < self.num_prefetch:
+                    cache = self.read_cache()
+                    seed = self.rng.getrandbits(32)
+                    self.pending.append(pool.apply_async(_batch_cache_worker, (cache, seed)))
+
+                if len(self.pending) == 0:
+                    break
+
+                self.ready_batches.extend(self.pending.popleft().get())
+                self.ready_packed = True
+
+    #### Resumable state: the batches left in the current cache (and in
+    # flight in prefetching mode), the reader state and the iterator's own
+    # RNG states; the global random and numpy.random states are left alone
+    def state_dict(self):
+        ready_batches = list(self.ready_batches)
+        for result in self.pending:
+            ready_batches.extend(result.get())
+        return {'ready_batches': ready_batches,
+                'ready_packed': self.ready_packed or len(self.pending) > 0,
+                'end_of_epoch': self.end_of_epoch,
+                'dataset': self.dataset.state_dict(),
+                'rng_state': self.rng.getstate(),
+                'data_rng_state': self.data_rng.getstate() if self.data_rng is not None else None}
+
+    def load_state_dict(self, state):
+        self.ready_batches = collections.deque(state['ready_batches'])
+        self.ready_packed = state['ready_packed']
+        self.end_of_epoch = state['end_of_epoch']
+        self.dataset.load_state_dict(state['dataset'])
+        self.rng.setstate(state['rng_state'])
+        if self.data_rng is not None:
+            self.data_rng.setstate(state['data_rng_state'])
+        self.restored = True
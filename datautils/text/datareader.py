@@ -1,107 +1,801 @@
 from __future__ import division
+import os
+import zlib
+import gzip
 import mmap
+import fcntl
 import glob
 import numpy
 import random
+import itertools
+import threading
+import contextlib
 import collections
+from multiprocessing.pool import ThreadPool
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from .utils import split_line, binarize_buffer
+
+#### Line offset index shared by the mmap based readers
+# Header of the sidecar index: [file size, file mtime in microseconds]
+_INDEX_HEADER = 2
+
+def _file_signature(data_path):
+    stat = os.stat(data_path)
+    return stat.st_size, int(stat.st_mtime * 1e6)
+
+def scan_line_offsets(data_mmap, chunk_size=1<<26):
+    # data_mmap can be an mmap or any bytes-like buffer
+    # Find all newlines chunk by chunk instead of calling readline per line
+    size = len(data_mmap)
+    offsets = [numpy.zeros(1, dtype='int64')] if size > 0 else []
+    for start in xrange(0, size, chunk_size):
+        chunk = numpy.frombuffer(data_mmap[start:start+chunk_size], dtype=numpy.uint8)
+        offsets.append(numpy.flatnonzero(chunk == ord('\n')).astype('int64') + start + 1)
+    if len(offsets) == 0:
+        return numpy.zeros(0, dtype='int64')
+    offsets = numpy.concatenate(offsets)
+    # A trailing newline does not start a new record
+    if offsets[-1] == size:
+        offsets = offsets[:-1]
+    return offsets
+
+_INDEX_SUFFIX = '.idx.npy'
+_BLOCK_INDEX_SUFFIX = '.blk.npy'
+
+def glob_shards(data_pattern):
+    # Shard paths matching data_pattern*, skipping the sidecar index files
+    return sorted(path for path in glob.glob(data_pattern+'*')
+                  if _INDEX_SUFFIX not in path and _BLOCK_INDEX_SUFFIX not in path)
+
+def load_line_offsets(data_path, data_mmap, index_path=None):
+    # Memory-map the sidecar index if it matches the data file, otherwise
+    # rescan the data file and try to persist a fresh index next to it
+    if index_path is None:
+        index_path = data_path + _INDEX_SUFFIX
+    signature = _file_signature(data_path)
+
+    if os.path.exists(index_path):
+        try:
+            index = numpy.load(index_path, mmap_mode='r')
+            if tuple(index[:_INDEX_HEADER]) == signature:
+                return index[_INDEX_HEADER:]
+        except (IOError, OSError, ValueError):
+            pass
+
+    offsets = scan_line_offsets(data_mmap)
+    index = numpy.empty(len(offsets) + _INDEX_HEADER, dtype='int64')
+    index[:_INDEX_HEADER] = signature
+    index[_INDEX_HEADER:] = offsets
+    try:
+        # Write to a temporary file first so that concurrent readers never
+        # see a partially written index
+        tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+        with open(tmp_path, 'wb') as index_file:
+            numpy.save(index_file, index)
+        os.rename(tmp_path, index_path)
+    except (IOError, OSError):
+        # Read-only data directory: keep the index in memory only
+        pass
+
+    return offsets
+
+#### Epoch order, optionally partitioned across data-parallel workers
+def block_shuffle_order(num_records, block_size, window_size, rng=numpy.random):
+    # Shuffle blocks of neighboring records, then shuffle records within
+    # windows of window_size consecutive positions. Reads of a window only
+    # touch window_size / block_size contiguous regions of the file.
+    num_blocks = (num_records + block_size - 1) // block_size
+    order = rng.permutation(num_blocks)[:, None] * block_size + numpy.arange(block_size)[None, :]
+    order = order.ravel()
+    order = order[order < num_records]
+    window_keys = numpy.arange(len(order)) // window_size + rng.random_sample(len(order))
+    return order[numpy.argsort(window_keys)]
+
+def epoch_order(num_records, shuffle=False, rank=0, world_size=1, seed=None,
+                block_size=None, window_size=None):
+    # All workers must draw the same permutation before taking their slice
+    if shuffle and world_size > 1 and seed is None:
+        raise ValueError('a shared seed is required to partition a shuffled order')
+    if shuffle:
+        rng = numpy.random if seed is None else numpy.random.RandomState(seed)
+        if block_size is not None:
+            order = block_shuffle_order(num_records, block_size, window_size or 16 * block_size, rng)
+        else:
+            order = rng.permutation(num_records)
+    else:
+        order = numpy.arange(num_records)
+    if world_size > 1:
+        # disjoint, equally sized contiguous slices; the remainder is dropped
+        per_rank = num_records // world_size
+        order = order[rank*per_rank:(rank+1)*per_rank]
+    return order
+
+def epoch_shards(path_list, shuffle_shard=False, rank=0, world_size=1, seed=None):
+    # Returns (shard seeds, shard paths, record partitions) for this worker.
+    # Whole shards are dealt out equally across workers; the len % world_size
+    # shards left over are visited by every worker, each reading the
+    # (rank, world_size) partition of their records. Other shards are read
+    # whole, partition (0, 1). Shards differ in size, so the number of records
+    # per worker can differ: stop data-parallel epochs at a fixed step count.
+    if shuffle_shard and world_size > 1 and seed is None:
+        raise ValueError('a shared seed is required to partition a shuffled shard list')
+    shard_ids = list(range(len(path_list)))
+    if shuffle_shard:
+        rng = random if seed is None else random.Random(seed)
+        rng.shuffle(shard_ids)
+
+    partitions = [(0, 1)] * len(shard_ids)
+    if world_size > 1:
+        per_rank = len(shard_ids) // world_size
+        leftover = shard_ids[per_rank*world_size:]
+        shard_ids = shard_ids[rank*per_rank:(rank+1)*per_rank] + leftover
+        partitions = [(0, 1)] * per_rank + [(rank, world_size)] * len(leftover)
+
+    # per shard seeds agree across workers since they only depend on the shard
+    shard_seeds = [None if seed is None else (seed * 1000003 + shard_id) % (1 << 32) for shard_id in shard_ids]
+    return shard_seeds, [path_list[shard_id] for shard_id in shard_ids], partitions
 
 # A thread safe text data reader
 class TextReader(object):
     def __init__(self, data_path):
         self.data_path = data_path
+        self.idx_lock = threading.Lock()
+        # block shuffle mode, see block_shuffle_order
+        self.block_size = None
+        self.window_size = None
 
-    def reset(self, shuffle=False):
-        if shuffle:
-            self.idx_queue = collections.deque(numpy.random.permutation(len(self)))
-        else:
-            self.idx_queue = collections.deque(range(len(self)))
+    def reset(self, shuffle=False, rank=0, world_size=1, seed=None):
+        # The epoch order is kept as an index array plus a cursor
+        self.idx_order = epoch_order(len(self), shuffle, rank, world_size, seed,
+                                     self.block_size, self.window_size)
+        self.idx_cursor = 0
 
     def next_index(self):
-        try:
-            curr_idx = self.idx_queue.popleft()
-        except:
-            return None
+        with self.idx_lock:
+            if self.idx_cursor >= len(self.idx_order):
+                return None
+            curr_idx = int(self.idx_order[self.idx_cursor])
+            self.idx_cursor += 1
         return curr_idx
 
+    def next_indices(self, n):
+        # Up to n next indices as an array view, empty at the end of the epoch
+        with self.idx_lock:
+            indices = self.idx_order[self.idx_cursor:self.idx_cursor+n]
+            self.idx_cursor += len(indices)
+        return indices
+
+    def num_remaining(self):
+        return len(self.idx_order) - self.idx_cursor
+
+    #### Resumable state: only the rest of the epoch order is kept
+    def state_dict(self):
+        return {'idx_order': numpy.array(self.idx_order[self.idx_cursor:])}
+
+    def load_state_dict(self, state):
+        self.idx_order = state['idx_order']
+        self.idx_cursor = 0
+
     def next_record(self):
+        curr_idx = self.next_index()
+        if curr_idx is not None:
+            return self.read_record(curr_idx)
+        else:
+            return None
+
+    # Random access to a record by index, implemented by the indexed readers
+    def read_record(self, idx):
         raise NotImplementedError
 
+    def source_paths(self):
+        return [self.data_path]
+
+def _slice_record(data_buffer, offsets, idx):
+    start = int(offsets[idx])
+    end = int(offsets[idx+1]) if idx + 1 < len(offsets) else len(data_buffer)
+    return data_buffer[start:end]
+
 class SmallText(TextReader):
     def __init__(self, data_path):
         super(SmallText, self).__init__(data_path)
-        
+
+        # One contiguous buffer plus line offsets instead of a list of lines
         with open(self.data_path, 'rb') as data_file:
-            self.records = data_file.readlines()
+            self.data_buffer = data_file.read()
+        self.record_offsets = scan_line_offsets(self.data_buffer)
 
         self.reset()
 
-    def next_record(self):
-        curr_idx = self.next_index()
-        if curr_idx is not None:
-            return self.records[curr_idx]
-        else:
-            return None
+    def read_record(self, idx):
+        return _slice_record(self.data_buffer, self.record_offsets, idx)
 
     def __len__(self):
-        return len(self.records)
+        return len(self.record_offsets)
 
 class LargeText(TextReader):
-    def __init__(self, data_path):
+    def __init__(self, data_path, index_path=None, block_size=None, window_size=None):
         super(LargeText, self).__init__(data_path)
-        
-        self.data_file = open(self.data_path, 'r+b')
+        self.index_path = index_path
+        self.block_size = block_size
+        self.window_size = window_size
+
+        self.data_file = open(self.data_path, 'rb')
         self.data_mmap = mmap.mmap(self.data_file.fileno(), 0, access = mmap.ACCESS_READ)
 
         self.init_mmap()
         self.reset()
 
     def init_mmap(self):
-        self.record_offsets = []
+        self.record_offsets = load_line_offsets(self.data_path, self.data_mmap, self.index_path)
+
+    def read_record(self, idx):
+        # slicing instead of seek + readline keeps concurrent reads safe
+        return _slice_record(self.data_mmap, self.record_offsets, idx)
+
+    def read_span(self, start_idx, num_records):
+        # Raw bytes of consecutive records plus their offsets within the
+        # returned buffer, e.g. for utils.tokenize_buffer
+        end_idx = min(start_idx + num_records, len(self.record_offsets))
+        start = int(self.record_offsets[start_idx])
+        end = int(self.record_offsets[end_idx]) if end_idx < len(self.record_offsets) else len(self.data_mmap)
+        return self.data_mmap[start:end], self.record_offsets[start_idx:end_idx] - start
+
+    def next_records(self, n):
+        # Read up to n records in ascending file order, return them in epoch order
+        indices = self.next_indices(n)
+        if len(indices) == 0:
+            return None
+        starts = self.record_offsets[indices]
+        next_indices = numpy.minimum(indices + 1, len(self.record_offsets) - 1)
+        ends = numpy.where(indices + 1 < len(self.record_offsets),
+                           self.record_offsets[next_indices], len(self.data_mmap))
+
+        records = [None] * len(indices)
+        for pos in numpy.argsort(starts, kind='mergesort'):
+            records[pos] = self.data_mmap[int(starts[pos]):int(ends[pos])]
+        return records
+
+    def __len__(self):
+        return len(self.record_offsets)
+
+    def __del__(self):
+        self.data_mmap.close()
+        self.data_file.close()
+
+#### Pre-binarized corpus: <prefix>.tok (int32 tokens), <prefix>.off (int64
+# record boundaries, one more than the number of records), <prefix>.vocab
+def _encode_lines(vocab, lines, tokenize):
+    # (tokens, lengths) of a list of lines, encoded with one vocab call
+    if tokenize is split_line:
+        return binarize_buffer(vocab, b''.join(lines))
+    symbols = [tokenize(line) for line in lines]
+    lengths = numpy.fromiter(map(len, symbols), dtype='int64', count=len(symbols))
+    return vocab.encode_batch(list(itertools.chain.from_iterable(symbols))), lengths
+
+def binarize_corpus(data_pattern, vocab, output_prefix, tokenize=split_line, multi_shard=False,
+                    chunk_size=1 << 22):
+    # Tokenize and encode the corpus once so that later epochs only slice arrays.
+    # Lines are encoded and written about chunk_size bytes at a time, and the
+    # outputs are renamed into place once complete.
+    if multi_shard:
+        path_list = glob_shards(data_pattern)
+    else:
+        path_list = [data_pattern]
+
+    tok_path, off_path = output_prefix + '.tok', output_prefix + '.off'
+    tmp_tok_path = '{}.{}.tmp'.format(tok_path, os.getpid())
+    tmp_off_path = '{}.{}.tmp'.format(off_path, os.getpid())
+    num_tokens = 0
+    with open(tmp_tok_path, 'wb') as tok_file, open(tmp_off_path, 'wb') as off_file:
+        numpy.zeros(1, dtype='int64').tofile(off_file)
+        for data_path in path_list:
+            with open(data_path, 'rb') as data_file:
+                while True:
+                    lines = data_file.readlines(chunk_size)
+                    if not lines:
+                        break
+                    tokens, lengths = _encode_lines(vocab, lines, tokenize)
+                    numpy.asarray(tokens, dtype='int32').tofile(tok_file)
+                    (num_tokens + numpy.cumsum(lengths)).astype('int64').tofile(off_file)
+                    num_tokens += int(lengths.sum())
+    os.rename(tmp_tok_path, tok_path)
+    os.rename(tmp_off_path, off_path)
+
+    vocab.save(output_prefix + '.vocab')
+
+def _memmap_or_empty(path, dtype):
+    # numpy.memmap refuses to map empty files
+    if os.path.getsize(path) == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r')
+
+class BinarizedText(TextReader):
+    def __init__(self, data_prefix):
+        super(BinarizedText, self).__init__(data_prefix)
+
+        self.tokens = _memmap_or_empty(data_prefix + '.tok', 'int32')
+        self.record_bounds = _memmap_or_empty(data_prefix + '.off', 'int64')
+        self.vocab_path = data_prefix + '.vocab'
+
+        self.reset()
+
+    @property
+    def record_lengths(self):
+        return numpy.diff(self.record_bounds)
+
+    def read_record(self, idx):
+        # Returns a view into the token array, no copy and no tokenization
+        return self.tokens[self.record_bounds[idx]:self.record_bounds[idx+1]]
+
+    def source_paths(self):
+        return [self.data_path + '.tok', self.data_path + '.off']
+
+    def __len__(self):
+        return max(len(self.record_bounds) - 1, 0)
+
+def open_text(data_path):
+    # Sequential binary reading of plain or gzip compressed files
+    if data_path.endswith('.gz'):
+        return gzip.open(data_path, 'rb')
+    return open(data_path, 'rb')
+
+class StreamingText(TextReader):
+    # Reads one or more files sequentially (no index, no random access) and
+    # shuffles through a bounded buffer of buffer_size records. Memory use is
+    # fixed by the buffer size and there is no startup scan.
+    def __init__(self, data_pattern, buffer_size=100000, multi_shard=True):
+        super(StreamingText, self).__init__(data_pattern)
+        if multi_shard:
+            self.path_list = glob_shards(data_pattern)
+        else:
+            self.path_list = [data_pattern]
+        self.buffer_size = buffer_size
+        self.stream = None
+
+        self.reset()
+
+    def reset(self, shuffle=False, rank=0, world_size=1, seed=None):
+        self.shuffle = shuffle
+        self.rng = random.Random(seed)
+        # split the files across workers and stride over the records of the
+        # files left over, see epoch_shards
+        _, self.epoch_paths, self.stream_partitions = epoch_shards(self.path_list, shuffle, rank, world_size, seed)
+
+        self.start_stream()
+        self.shuffle_buffer = []
+
+    def start_stream(self, start_path=0, start_line=0, record_idx=0):
+        if self.stream is not None:
+            self.stream.close()
+        self.stream_pos = (start_path, start_line, record_idx)
+        self.stream = self.iter_stream(start_path, start_line, record_idx)
+
+    def iter_stream(self, start_path, start_line, record_idx):
+        # stream_pos always points right after the last line read
+        for path_pos in range(start_path, len(self.epoch_paths)):
+            rank, world_size = self.stream_partitions[path_pos]
+            with open_text(self.epoch_paths[path_pos]) as data_file:
+                line_idx = start_line if path_pos == start_path else 0
+                for line in itertools.islice(data_file, line_idx, None):
+                    line_idx += 1
+                    record_idx += 1
+                    self.stream_pos = (path_pos, line_idx, record_idx)
+                    if (line_idx - 1) % world_size == rank:
+                        yield line
+
+    #### Resumable state: resuming skips the already read lines of the current
+    # file, since plain and gzip streams have no record index
+    def state_dict(self):
+        return {'shuffle': self.shuffle, 'rng_state': self.rng.getstate(),
+                'epoch_paths': list(self.epoch_paths), 'stream_partitions': list(self.stream_partitions),
+                'stream_pos': self.stream_pos, 'shuffle_buffer': list(self.shuffle_buffer)}
+
+    def load_state_dict(self, state):
+        self.shuffle = state['shuffle']
+        self.rng = random.Random()
+        self.rng.setstate(state['rng_state'])
+        self.epoch_paths = state['epoch_paths']
+        self.stream_partitions = state['stream_partitions']
+        self.start_stream(*state['stream_pos'])
+        self.shuffle_buffer = list(state['shuffle_buffer'])
+
+    def next_record(self):
+        if not self.shuffle:
+            return next(self.stream, None)
+
+        # keep the buffer full, then emit a random element of it
+        while len(self.shuffle_buffer) < self.buffer_size:
+            record = next(self.stream, None)
+            if record is None:
+                break
+            self.shuffle_buffer.append(record)
+        if len(self.shuffle_buffer) == 0:
+            return None
+
+        pos = self.rng.randrange(len(self.shuffle_buffer))
+        self.shuffle_buffer[pos], self.shuffle_buffer[-1] = self.shuffle_buffer[-1], self.shuffle_buffer[pos]
+        return self.shuffle_buffer.pop()
+
+#### Block compressed layout: every block_records lines form an independent
+# gzip member, so the file is still a valid gzip stream for StreamingText.
+# The sidecar <path>.blk.npy holds [block_records, num_records, block offsets].
+def compress_blocks(data_path, output_path, block_records=4096, level=6):
+    block_offsets = [0]
+    num_records = 0
+    with open_text(data_path) as data_file, open(output_path, 'wb') as output_file:
         while True:
-            pos = self.data_mmap.tell()
-            line = self.data_mmap.readline()
-            if line == '':
+            lines = list(itertools.islice(data_file, block_records))
+            if len(lines) == 0:
                 break
-            self.record_offsets.append(pos)
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            block = compressor.compress(b''.join(lines)) + compressor.flush()
+            output_file.write(block)
+            block_offsets.append(block_offsets[-1] + len(block))
+            num_records += len(lines)
+
+    index = numpy.array([block_records, num_records] + block_offsets, dtype='int64')
+    with open(output_path + _BLOCK_INDEX_SUFFIX, 'wb') as index_file:
+        numpy.save(index_file, index)
+
+class BlockCompressedText(TextReader):
+    # Random access into a compress_blocks file. Decompressed blocks are kept
+    # in a small LRU cache; next_records decompresses the blocks it needs on
+    # num_threads helper threads (zlib releases the GIL). Shuffled epochs use
+    # block shuffling aligned with the compressed blocks by default.
+    def __init__(self, data_path, num_threads=4, cache_blocks=16, window_size=None):
+        super(BlockCompressedText, self).__init__(data_path)
+
+        index = numpy.load(data_path + _BLOCK_INDEX_SUFFIX)
+        self.block_records, self.num_records = int(index[0]), int(index[1])
+        self.block_offsets = index[2:]
+        self.block_size = self.block_records
+        self.window_size = window_size
+
+        self.data_file = open(self.data_path, 'rb')
+        if self.num_records > 0:
+            self.data_mmap = mmap.mmap(self.data_file.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self.data_mmap = None
+
+        self.cache_blocks = cache_blocks
+        self.block_cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.pool = ThreadPool(num_threads) if num_threads > 0 else None
+
+        self.reset()
+
+    def load_block(self, block_idx):
+        start, end = int(self.block_offsets[block_idx]), int(self.block_offsets[block_idx+1])
+        data_buffer = zlib.decompress(self.data_mmap[start:end], 16 + zlib.MAX_WBITS)
+        return data_buffer, scan_line_offsets(data_buffer)
+
+    def cache_block(self, block_idx, block):
+        with self.cache_lock:
+            self.block_cache[block_idx] = block
+            while len(self.block_cache) > self.cache_blocks:
+                self.block_cache.popitem(last=False)
+
+    def cached_block(self, block_idx):
+        with self.cache_lock:
+            block = self.block_cache.pop(block_idx, None)
+            if block is not None:
+                # move to the most recently used end
+                self.block_cache[block_idx] = block
+        return block
+
+    def get_block(self, block_idx):
+        block = self.cached_block(block_idx)
+        if block is None:
+            block = self.load_block(block_idx)
+            self.cache_block(block_idx, block)
+        return block
+
+    def read_record(self, idx):
+        data_buffer, offsets = self.get_block(idx // self.block_records)
+        return _slice_record(data_buffer, offsets, idx % self.block_records)
+
+    def next_records(self, n):
+        indices = self.next_indices(n)
+        if len(indices) == 0:
+            return None
+
+        blocks = {}
+        for block_idx in numpy.unique(indices // self.block_records):
+            blocks[int(block_idx)] = self.cached_block(block_idx)
+        missing = [block_idx for block_idx, block in blocks.items() if block is None]
+        if self.pool is not None:
+            loaded = self.pool.map(self.load_block, missing)
+        else:
+            loaded = [self.load_block(block_idx) for block_idx in missing]
+        for block_idx, block in zip(missing, loaded):
+            blocks[block_idx] = block
+            self.cache_block(block_idx, block)
+
+        records = []
+        for idx in indices:
+            data_buffer, offsets = blocks[int(idx) // self.block_records]
+            records.append(_slice_record(data_buffer, offsets, int(idx) % self.block_records))
+        return records
+
+    def __len__(self):
+        return self.num_records
+
+    def __del__(self):
+        if self.pool is not None:
+            self.pool.terminate()
+        if self.data_mmap is not None:
+            self.data_mmap.close()
+        self.data_file.close()
+
+#### Persistent cache of processed records
+# Sits between an indexed reader and BucketIterator (use it as the dataset
+# and drop process_func from the iterator). Processed records are kept in an
+# in-memory LRU of max_memory_records entries and spilled to
+# <cache_path>.data (pickled records) indexed by <cache_path>.index.npy
+# (offset, length) per record index. The cache is rebuilt whenever the source
+# files or config change, so config must describe everything process_func
+# depends on (e.g. the tokenizer and the vocab file).
+# Processes may share a cache_path: building the cache and spilling a record
+# hold an exclusive flock on <cache_path>.lock, and a record spilled by
+# another process is read from the file instead of being processed again.
+class ProcessedCache(object):
+    def __init__(self, dataset, process_func, cache_path, config, max_memory_records=100000):
+        self.dataset = dataset
+        self.process_func = process_func
+        self.max_memory_records = max_memory_records
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.lock_file = open(cache_path + '.lock', 'a')
+
+        fingerprint = repr(([_file_signature(path) for path in dataset.source_paths()],
+                            len(dataset), config))
+        meta_path = cache_path + '.meta'
+        index_path = cache_path + '.index.npy'
+        data_path = cache_path + '.data'
+
+        with self.file_lock():
+            valid = False
+            if os.path.exists(meta_path) and os.path.exists(index_path) and os.path.exists(data_path):
+                with open(meta_path, 'r') as meta_file:
+                    valid = meta_file.read() == fingerprint
+            if valid:
+                self.index = numpy.load(index_path, mmap_mode='r+')
+            else:
+                self.index = numpy.lib.format.open_memmap(index_path, mode='w+', dtype='int64',
+                                                          shape=(len(dataset), 2))
+                self.index.fill(-1)
+                self.index.flush()
+                open(data_path, 'wb').close()
+                with open(meta_path, 'w') as meta_file:
+                    meta_file.write(fingerprint)
+
+        self.data_file = open(data_path, 'r+b')
+        self.data_mmap = None
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def reset(self, *args, **kwargs):
+        self.dataset.reset(*args, **kwargs)
+
+    def read_bytes(self, offset, length):
+        # remap when the spill file has grown past the current mapping
+        if self.data_mmap is None or offset + length > len(self.data_mmap):
+            if self.data_mmap is not None:
+                self.data_mmap.close()
+            self.data_mmap = mmap.mmap(self.data_file.fileno(), 0, access = mmap.ACCESS_READ)
+        return self.data_mmap[offset:offset+length]
+
+    def spill(self, idx, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.file_lock():
+            # another process may have spilled the record meanwhile
+            if self.index[idx, 0] >= 0:
+                return
+            self.data_file.seek(0, os.SEEK_END)
+            offset = self.data_file.tell()
+            self.data_file.write(data)
+            # data must hit the file before the index points to it
+            self.data_file.flush()
+            self.index[idx] = (offset, len(data))
+
+    def read_record(self, idx):
+        with self.lock:
+            record = self.memory.pop(idx, None)
+            if record is None:
+                offset, length = self.index[idx]
+                if offset >= 0:
+                    record = pickle.loads(self.read_bytes(int(offset), int(length)))
+                else:
+                    record = self.process_func(self.dataset.read_record(idx))
+                    self.spill(idx, record)
+            self.memory[idx] = record
+            while len(self.memory) > self.max_memory_records:
+                self.memory.popitem(last=False)
+        return record
 
     def next_record(self):
-        curr_idx = self.next_index()
+        curr_idx = self.dataset.next_index()
         if curr_idx is not None:
-            self.data_mmap.seek(self.record_offsets[curr_idx])
-            return self.data_mmap.readline()
+            return self.read_record(curr_idx)
         else:
             return None
 
+    def state_dict(self):
+        return self.dataset.state_dict()
+
+    def load_state_dict(self, state):
+        self.dataset.load_state_dict(state)
+
     def __len__(self):
-        return len(self.record_offsets)
+        return len(self.dataset)
 
     def __del__(self):
-        self.data_mmap.close()
+        if self.data_mmap is not None:
+            self.data_mmap.close()
         self.data_file.close()
+        self.lock_file.close()
+
+class ShardLoader(threading.Thread):
+    # Loads the shards of path_list in order on a background thread. At most
+    # num_prefetch shards are loaded (or being loaded) ahead of the consumer.
+    def __init__(self, shard_class, path_list, num_prefetch=1):
+        super(ShardLoader, self).__init__()
+        self.daemon = True
+
+        self.shard_class = shard_class
+        self.path_list = list(path_list)
+        self.stopped = threading.Event()
+        self.shards = queue.Queue()
+        self.slots = queue.Queue()
+        for _ in range(num_prefetch):
+            self.slots.put(None)
+
+        self.start()
+
+    def run(self):
+        for path in self.path_list:
+            # wait for a free slot while staying responsive to stop()
+            while not self.stopped.is_set():
+                try:
+                    self.slots.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    continue
+            if self.stopped.is_set():
+                return
+
+            try:
+                shard = self.shard_class(path)
+            except Exception as e:
+                self.shards.put(e)
+                return
+            self.shards.put(shard)
+
+    def next_shard(self):
+        shard = self.shards.get()
+        self.slots.put(None)
+        if isinstance(shard, Exception):
+            raise shard
+        return shard
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
 
 class MultiShardText(object):
-    def __init__(self, data_pattern, shuffle_shard=True):
-        self.path_list = glob.glob(data_pattern+'*')
+    shard_class = SmallText
+    shard_loader = None
+
+    def __init__(self, data_pattern, shuffle_shard=True, num_prefetch=1):
+        self.path_list = glob_shards(data_pattern)
         self.shuffle_shard = shuffle_shard
+        # number of shards loaded in the background besides the current one
+        self.num_prefetch = num_prefetch
+        self.shard_loader = None
 
         self.reset()
 
-    def reset(self, shuffle=False):
+    def reset(self, shuffle=False, rank=0, world_size=1, seed=None):
+        # The loader and the first shard are only started by next_record, so
+        # that constructing and then resetting the reader loads nothing twice
         self.shuffle = shuffle
         self.shard_idx = -1
-        if self.shuffle_shard:
-            random.shuffle(self.path_list)
+        self.init_epoch(rank, world_size, seed)
+        self.stop_loader()
+        self.curr_shard = None
+        self.started = False
+
+    def start_epoch(self):
+        self.started = True
+        self.start_loader()
         self.load_next_shard()
 
+    def init_epoch(self, rank, world_size, seed):
+        self.shard_seeds, self.epoch_paths, self.shard_partitions = \
+            epoch_shards(self.path_list, self.shuffle_shard, rank, world_size, seed)
+
+    def reset_shard(self, shard):
+        rank, world_size = self.shard_partitions[self.shard_idx]
+        if self.shuffle or world_size > 1:
+            shard.reset(self.shuffle, rank, world_size, self.shard_seeds[self.shard_idx])
+
+    def stop_loader(self):
+        if self.shard_loader is not None:
+            self.shard_loader.stop()
+            self.shard_loader = None
+
+    def close(self):
+        # stops the loader thread and drops the shards it has loaded ahead
+        self.stop_loader()
+        self.curr_shard = None
+
+    def start_loader(self, start=0):
+        self.stop_loader()
+        if self.num_prefetch > 0:
+            self.shard_loader = ShardLoader(self.shard_class, self.epoch_paths[start:], self.num_prefetch)
+
+    def open_shard(self):
+        if self.shard_loader is not None:
+            return self.shard_loader.next_shard()
+        else:
+            return self.shard_class(self.epoch_paths[self.shard_idx])
+
     def load_next_shard(self):
         self.shard_idx += 1
-        if self.shard_idx >= len(self.path_list):
-            self.curr_shard = None
-        else:
-            self.curr_shard = SmallText(self.path_list[self.shard_idx])
-            if self.shuffle: self.curr_shard.reset(self.shuffle)
+        # drop the exhausted shard before the next one takes its slot
+        self.curr_shard = None
+        if self.shard_idx < len(self.epoch_paths):
+            self.curr_shard = self.open_shard()
+            self.reset_shard(self.curr_shard)
+
+    #### Resumable state: shard order and position plus the current shard state
+    def epoch_state(self):
+        return {'shuffle': self.shuffle, 'shard_idx': self.shard_idx,
+                'epoch_paths': list(self.epoch_paths), 'shard_seeds': list(self.shard_seeds),
+                'shard_partitions': list(self.shard_partitions)}
+
+    def load_epoch_state(self, state):
+        self.shuffle = state['shuffle']
+        self.shard_idx = state['shard_idx']
+        self.epoch_paths = state['epoch_paths']
+        self.shard_seeds = state['shard_seeds']
+        self.shard_partitions = state['shard_partitions']
+
+    def state_dict(self):
+        state = self.epoch_state()
+        state['curr_shard'] = self.curr_shard.state_dict() if self.curr_shard is not None else None
+        return state
+
+    def load_state_dict(self, state):
+        self.load_epoch_state(state)
+        self.curr_shard = None
+        # a state saved before the first record restarts the epoch lazily
+        self.started = self.shard_idx >= 0
+        if not self.started:
+            self.stop_loader()
+            return
+        self.start_loader(self.shard_idx)
+        if state['curr_shard'] is not None:
+            self.curr_shard = self.open_shard()
+            self.curr_shard.load_state_dict(state['curr_shard'])
 
     def next_record(self):
+        if not self.started:
+            self.start_epoch()
+
         # Catch StopIteration and load the next shard
         while self.curr_shard is not None:
             record = self.curr_shard.next_record()
@@ -112,25 +806,16 @@ class MultiShardText(object):
 
         return None
 
-class ParallelText(object):
+    def __del__(self):
+        self.close()
+
+class ParallelText(TextReader):
     def __init__(self, data_paths):
+        super(ParallelText, self).__init__(data_paths)
         self.data_paths = data_paths
 
-    def next_index(self):
-        try:
-            curr_idx = self.idx_queue.popleft()
-        except:
-            return None
-        return curr_idx
-
-    def reset(self, shuffle=False):
-        if shuffle:
-            self.idx_queue = collections.deque(numpy.random.permutation(len(self)))
-        else:
-            self.idx_queue = collections.deque(range(len(self)))
-
-    def next_record(self):
-        raise NotImplementedError
+    def source_paths(self):
+        return list(self.data_paths)
 
     def __iter__(self):
         return self
@@ -138,60 +823,45 @@ class ParallelText(object):
 class SmallParallelText(ParallelText):
     def __init__(self, data_paths):
         super(SmallParallelText, self).__init__(data_paths)
-        
-        self.records = []
-        for record in zip(*[open(data_path, 'rb') for data_path in self.data_paths]):
-            self.records.append(record)
+
+        self.data_buffers = []
+        for data_path in self.data_paths:
+            with open(data_path, 'rb') as data_file:
+                self.data_buffers.append(data_file.read())
+        self.record_offsets = [scan_line_offsets(data_buffer) for data_buffer in self.data_buffers]
+        self.num_records = min(len(offsets) for offsets in self.record_offsets)
 
         self.reset()
 
-    def next_record(self):
-        curr_idx = self.next_index()
-        if curr_idx is not None:
-            return self.records[curr_idx]
-        else:
-            return None
+    def read_record(self, idx):
+        return tuple(_slice_record(data_buffer, offsets, idx)
+                     for data_buffer, offsets in zip(self.data_buffers, self.record_offsets))
 
     def __len__(self):
-        return len(self.records)
+        return self.num_records
 
 class LargeParallelText(ParallelText):
     def __init__(self, data_paths):
         super(LargeParallelText, self).__init__(data_paths)
         
-        self.data_files = [open(data_path, 'r+b') for data_path in self.data_paths]
+        self.data_files = [open(data_path, 'rb') for data_path in self.data_paths]
         self.data_mmaps = [mmap.mmap(data_file.fileno(), 0, access = mmap.ACCESS_READ) for data_file in self.data_files]
 
         self.init_mmap()
         self.reset()
 
     def init_mmap(self):
-        self.record_offsets = []
-        while True:
-            pos_tuple = tuple(data_mmap.tell() for data_mmap in self.data_mmaps)
-            line_tuple = tuple(data_mmap.readline() for data_mmap in self.data_mmaps)
-
-            if any([line == '' for line in line_tuple]):
-                break
+        # One offset array per file, the shortest file bounds the records
+        self.record_offsets = [load_line_offsets(data_path, data_mmap)
+                               for data_path, data_mmap in zip(self.data_paths, self.data_mmaps)]
+        self.num_records = min(len(offsets) for offsets in self.record_offsets)
 
-            self.record_offsets.append(pos_tuple)
-
-    def next_record(self):
-        curr_idx = self.next_index()
-        if curr_idx is not None:
-            pos_tuple = self.record_offsets[curr_idx]
-            record = []
-            for data_mmap, pos in zip(self.data_mmaps, pos_tuple):
-                data_mmap.seek(pos)
-                line = data_mmap.readline()
-                record.append(line)
-
-            return tuple(record)
-        else:
-            return None
+    def read_record(self, idx):
+        return tuple(_slice_record(data_mmap, offsets, idx)
+                     for data_mmap, offsets in zip(self.data_mmaps, self.record_offsets))
 
     def __len__(self):
-        return len(self.record_offsets)
+        return self.num_records
 
     def __del__(self):
         for data_mmap in self.data_mmaps:
@@ -199,33 +869,93 @@ class LargeParallelText(ParallelText):
         for data_file in self.data_files:
             data_file.close()
 
-class MultiShardParallelText(object):
-    def __init__(self, data_patterns, shuffle_shard=True):
-        self.path_list = zip(*[glob.glob(data_pattern+'*') for data_pattern in data_patterns])
+class MultiShardParallelText(MultiShardText):
+    shard_class = SmallParallelText
+
+    def __init__(self, data_patterns, shuffle_shard=True, num_prefetch=1):
+        # shards of the different sides are matched by their sorted order
+        self.path_list = list(zip(*[glob_shards(data_pattern) for data_pattern in data_patterns]))
         self.shuffle_shard = shuffle_shard
+        self.num_prefetch = num_prefetch
+        self.shard_loader = None
 
         self.reset()
 
-    def reset(self, shuffle=False):
+class InterleavedShardText(MultiShardText):
+    # Keeps num_open shards open as lazy mmap readers and draws each record
+    # from a random open shard, weighted by its number of remaining records.
+    # Only the offset indexes of the open shards are resident in memory.
+    shard_class = LargeText
+
+    def __init__(self, data_pattern, num_open=8, shuffle_shard=True):
+        self.path_list = glob_shards(data_pattern)
+        self.num_open = num_open
+        self.shuffle_shard = shuffle_shard
+
+        self.reset()
+
+    def reset(self, shuffle=False, rank=0, world_size=1, seed=None):
         self.shuffle = shuffle
         self.shard_idx = -1
-        if self.shuffle_shard:
-            random.shuffle(self.path_list)
-        self.load_next_shard()
+        self.init_epoch(rank, world_size, seed)
+        # picks the shard of every record, saved with the reader state
+        self.rng = random.Random(seed)
 
-    def load_next_shard(self):
+        # [shard, number of remaining records, position in epoch_paths]
+        self.open_shards = []
+        for _ in range(self.num_open):
+            self.open_next_shard()
+
+    def open_next_shard(self):
         self.shard_idx += 1
-        if self.shard_idx >= len(self.path_list):
-            self.curr_shard = None
-        else:
-            self.curr_shard = SmallParallelText(self.path_list[self.shard_idx], self.shuffle)
+        if self.shard_idx < len(self.epoch_paths):
+            shard = self.shard_class(self.epoch_paths[self.shard_idx])
+            self.reset_shard(shard)
+            self.open_shards.append([shard, shard.num_remaining(), self.shard_idx])
 
     def next_record(self):
-        while self.curr_shard is not None:
-            record = self.curr_shard.next_record()
+        while len(self.open_shards) > 0:
+            total = sum(remain for _, remain, _ in self.open_shards)
+            pick = self.rng.random() * total
+            for pos, (shard, remain, _) in enumerate(self.open_shards):
+                pick -= remain
+                if pick < 0 or pos == len(self.open_shards) - 1:
+                    break
+
+            record = shard.next_record()
             if record is None:
-                self.load_next_shard()
+                # replace the exhausted shard with the next one
+                del self.open_shards[pos]
+                self.open_next_shard()
                 continue
+            self.open_shards[pos][1] -= 1
             return record
 
         return None
+
+    def state_dict(self):
+        state = self.epoch_state()
+        state['open_shards'] = [(path_pos, shard.state_dict()) for shard, _, path_pos in self.open_shards]
+        state['rng_state'] = self.rng.getstate()
+        return state
+
+    def load_state_dict(self, state):
+        self.load_epoch_state(state)
+        self.rng = random.Random()
+        self.rng.setstate(state['rng_state'])
+        self.open_shards = []
+        for path_pos, shard_state in state['open_shards']:
+            shard = self.shard_class(self.epoch_paths[path_pos])
+            shard.load_state_dict(shard_state)
+            self.open_shards.append([shard, shard.num_remaining(), path_pos])
+
+class InterleavedShardParallelText(InterleavedShardText):
+    shard_class = LargeParallelText
+
+    def __init__(self, data_patterns, num_open=8, shuffle_shard=True):
+        # shards of the different sides are matched by their sorted order
+        self.path_list = list(zip(*[glob_shards(data_pattern) for data_pattern in data_patterns]))
+        self.num_open = num_open
+        self.shuffle_shard = shuffle_shard
+
+        self.reset()
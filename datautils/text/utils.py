@@ -1,4 +1,5 @@
 import numpy
+import itertools
 
 def tuplize_share(func, batch=False):
     def tuplize_share_core(record):
@@ -21,56 +22,236 @@ def tuplize_sep(funcs, batch=False):
 def split_line(line):
     return line.strip().split()
 
+#### Stable 64-bit FNV-1a hash of many byte spans at once, vectorized over the
+# spans (one pass per byte position). Shared by the vocabularies.
+_FNV_OFFSET = numpy.uint64(14695981039346656037)
+_FNV_PRIME = numpy.uint64(1099511628211)
+_FNV_OFFSET_INT, _FNV_PRIME_INT, _FNV_MASK = int(_FNV_OFFSET), int(_FNV_PRIME), (1 << 64) - 1
+
+def hash_spans(data, starts, lengths):
+    if len(starts) == 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    data = numpy.frombuffer(data, dtype=numpy.uint8) if not isinstance(data, numpy.ndarray) else data
+    # sorted by decreasing length, the spans still active at a byte position
+    # are a prefix, so every pass works on contiguous slices
+    order = numpy.argsort(-lengths)
+    starts = starts[order]
+    num_active = numpy.bincount(lengths, minlength=1)[::-1].cumsum()[::-1]
+    hashes = numpy.empty(len(starts), dtype=numpy.uint64)
+    hashes.fill(_FNV_OFFSET)
+    for pos in range(1, len(num_active)):
+        n = num_active[pos]
+        hashes[:n] ^= data[starts[:n] + (pos - 1)]
+        hashes[:n] *= _FNV_PRIME
+    result = numpy.empty_like(hashes)
+    result[order] = hashes
+    return result
+
+def hash_symbol(sym):
+    # Scalar version for single symbols, where numpy calls cost more than
+    # the hash itself
+    sym_hash = _FNV_OFFSET_INT
+    for byte in bytearray(sym):
+        sym_hash = ((sym_hash ^ byte) * _FNV_PRIME_INT) & _FNV_MASK
+    return sym_hash
+
+def hash_symbols(symbols):
+    # Hash a list of bytes symbols through one joined buffer
+    lengths = numpy.fromiter(map(len, symbols), dtype='int64', count=len(symbols))
+    starts = numpy.cumsum(lengths) - lengths
+    return hash_spans(b''.join(symbols), starts, lengths)
+
+#### Vectorized whitespace tokenization of many records in one byte buffer,
+# e.g. a contiguous slice of a LargeText mmap. Tokens match split_line.
+_IS_SPACE = numpy.zeros(256, dtype=bool)
+_IS_SPACE[[ord(c) for c in ' \t\n\r\x0b\x0c']] = True
+
+def tokenize_buffer(data, record_offsets=None):
+    # Returns (record_bounds, token_starts, token_lengths): the tokens of
+    # record i are token_starts[record_bounds[i]:record_bounds[i+1]].
+    # Records are the lines of data unless record_offsets gives their starts.
+    if not isinstance(data, numpy.ndarray):
+        data = numpy.frombuffer(data, dtype=numpy.uint8) if len(data) > 0 else numpy.zeros(0, dtype=numpy.uint8)
+    if record_offsets is None:
+        record_offsets = numpy.concatenate([[0], numpy.flatnonzero(data == ord('\n')) + 1])
+        record_offsets = record_offsets[record_offsets < len(data)]
+    record_offsets = numpy.asarray(record_offsets, dtype='int64')
+
+    # a token starts at a non-space byte after a space, the buffer start or a
+    # record start, and ends before a space, the buffer end or a record start
+    is_space = _IS_SPACE[data]
+    boundary = numpy.zeros(len(data) + 1, dtype=bool)
+    boundary[0] = boundary[-1] = True
+    boundary[record_offsets] = True
+    starts_mask = ~is_space & (boundary[:-1] | numpy.concatenate([[True], is_space[:-1]]))
+    ends_mask = ~is_space & (boundary[1:] | numpy.concatenate([is_space[1:], [True]]))
+    token_starts = numpy.flatnonzero(starts_mask)
+    token_lengths = numpy.flatnonzero(ends_mask) + 1 - token_starts
+
+    record_bounds = numpy.searchsorted(token_starts, numpy.append(record_offsets, len(data)))
+    return record_bounds, token_starts, token_lengths
+
+def encode_tokens(vocab, data, token_starts, token_lengths):
+    # Batched vocab lookup on token spans; hash-based vocabularies never
+    # materialize the tokens as Python objects
+    if hasattr(vocab, 'encode_hashes'):
+        if not isinstance(data, numpy.ndarray):
+            data = numpy.frombuffer(data, dtype=numpy.uint8)
+        return vocab.encode_hashes(hash_spans(data, token_starts, token_lengths))
+    data = data.tobytes() if isinstance(data, numpy.ndarray) else data
+    return vocab.encode_batch([data[start:start+length] for start, length in zip(token_starts, token_lengths)])
+
+def binarize_buffer(vocab, data, record_offsets=None):
+    # Returns (tokens, lengths), ready for pack_padded
+    record_bounds, token_starts, token_lengths = tokenize_buffer(data, record_offsets)
+    if len(token_starts) > 0:
+        tokens = encode_tokens(vocab, data, token_starts, token_lengths)
+    else:
+        tokens = numpy.zeros(0, dtype='int64')
+    return tokens, numpy.diff(record_bounds)
+
 def binarize(vocab, func):
+    # Works with Vocab, FrozenVocab and HashedVocab
     def binarize_core(record):
         symbols = func(record)
-        indices = [vocab.encode(sym) for sym in symbols]
+        indices = vocab.encode_batch(symbols).tolist()
         return indices
 
     return binarize_core
 
-def pack_binary(padidx, create_mask=False, reverse_seq=False, align_right=False, floatX='float32'):
+class BufferRing(object):
+    # Recycles num_buffers flat arrays for the packers. An array returned by
+    # get() is overwritten num_buffers calls later, so the consumer must be
+    # done with a batch before that. BucketIterator packs each batch only when
+    # yielding it, so a batch stays valid for num_buffers - 1 more batches.
+    def __init__(self, num_buffers=2):
+        self.buffers = [None] * num_buffers
+        self.pos = 0
+
+    def get(self, shape, dtype):
+        size = int(numpy.prod(shape))
+        buf = self.buffers[self.pos]
+        if buf is None or buf.dtype != numpy.dtype(dtype) or buf.size < size:
+            buf = numpy.empty(size, dtype=dtype)
+            self.buffers[self.pos] = buf
+        self.pos = (self.pos + 1) % len(self.buffers)
+        return buf[:size].reshape(shape)
+
+def _empty(shape, dtype, ring):
+    if ring is None:
+        return numpy.empty(shape, dtype=dtype)
+    return ring.get(shape, dtype)
+
+def concat_records(batch, dtype='int64'):
+    # Concatenated tokens and lengths of a batch of lists or numpy arrays
+    lengths = numpy.fromiter((len(record) for record in batch), dtype='int64', count=len(batch))
+    if len(batch) > 0 and isinstance(batch[0], numpy.ndarray):
+        tokens = numpy.concatenate(batch).astype(dtype, copy=False)
+    else:
+        tokens = numpy.fromiter(itertools.chain.from_iterable(batch), dtype=dtype, count=lengths.sum())
+    return tokens, lengths
+
+def scatter_positions(lengths, reverse_seq=False, align_right=False):
+    # (time step, column) of every token of the concatenated batch
+    maxlen, batch_size = int(lengths.max()), len(lengths)
+    starts = numpy.cumsum(lengths) - lengths
+    steps = numpy.arange(lengths.sum()) - numpy.repeat(starts, lengths)
+    if reverse_seq:
+        steps = numpy.repeat(lengths - 1, lengths) - steps
+    if align_right:
+        steps += numpy.repeat(maxlen - lengths, lengths)
+    cols = numpy.repeat(numpy.arange(batch_size), lengths)
+    return steps, cols
+
+def fill_mask(mask, lengths, align_right=False):
+    maxlen = mask.shape[0]
+    time_idx = numpy.arange(maxlen)[:, None]
+    if align_right:
+        mask[...] = time_idx >= (maxlen - lengths)[None, :]
+    else:
+        mask[...] = time_idx < lengths[None, :]
+    return mask
+
+def pack_padded(tokens, lengths, padidx, create_mask=False, reverse_seq=False, align_right=False,
+                floatX='float32', dtype='int64', data_ring=None, mask_ring=None):
+    # Scatter the concatenated tokens into a (maxlen, batch) matrix at once
+    maxlen, batch_size = int(lengths.max()), len(lengths)
+    data = _empty((maxlen, batch_size), dtype, data_ring)
+    data.fill(padidx)
+    data[scatter_positions(lengths, reverse_seq, align_right)] = tokens
+
+    if create_mask:
+        mask = fill_mask(_empty((maxlen, batch_size), floatX, mask_ring), lengths, align_right)
+        return data, mask
+    else:
+        return data
+
+def pack_binary(padidx, create_mask=False, reverse_seq=False, align_right=False, floatX='float32',
+                dtype='int64', num_buffers=0):
+    # num_buffers > 0 recycles that many output buffers instead of allocating per batch
+    data_ring = BufferRing(num_buffers) if num_buffers > 0 else None
+    mask_ring = BufferRing(num_buffers) if num_buffers > 0 and create_mask else None
+
     def pack_binary_core(batch):
-        maxlen = max(map(len, batch))
-        data = numpy.zeros((maxlen, len(batch)), dtype='int64')
-        data.fill(padidx)
-        for idx in xrange(len(batch)):
-            if reverse_seq:
-                record = list(reversed(batch[idx]))
-            else:
-                record = batch[idx]
-            if align_right:
-                data[-len(record):, idx] = record
-            else:
-                data[:len(record), idx] = record
-
-        if create_mask:
-            mask = numpy.not_equal(data, padidx).astype(floatX)
-            return data, mask
-        else:
-            return data
-        
+        tokens, lengths = concat_records(batch, dtype)
+        return pack_padded(tokens, lengths, padidx, create_mask, reverse_seq, align_right,
+                           floatX, dtype, data_ring, mask_ring)
+
     return pack_binary_core
 
-def pack_string(vocab, create_mask=False, reverse_seq=False, align_right=False, floatX='float32'):
+def pack_string(vocab, create_mask=False, reverse_seq=False, align_right=False, floatX='float32',
+                dtype='int64', num_buffers=0):
+    data_ring = BufferRing(num_buffers) if num_buffers > 0 else None
+    mask_ring = BufferRing(num_buffers) if num_buffers > 0 and create_mask else None
+
     def pack_string_core(batch):
-        maxlen = max(map(len, batch))
-        data = numpy.zeros((maxlen, len(batch)), dtype='int64')
-        data.fill(vocab.pad)
-        for idx in xrange(len(batch)):
-            if reverse_seq:
-                record = map(vocab.encode, reversed(batch[idx]))
-            else:
-                record = map(vocab.encode, batch[idx])
-            if align_right:
-                data[-len(record):, idx] = record
-            else:
-                data[:len(record), idx] = record
-
-        if create_mask:
-            mask = numpy.not_equal(data, padidx).astype(floatX)
-            return data, mask
-        else:
-            return data
+        lengths = numpy.fromiter((len(record) for record in batch), dtype='int64', count=len(batch))
+        tokens = vocab.encode_batch(list(itertools.chain.from_iterable(batch))).astype(dtype, copy=False)
+        return pack_padded(tokens, lengths, vocab.pad, create_mask, reverse_seq, align_right,
+                           floatX, dtype, data_ring, mask_ring)
 
     return pack_string_core
+
+def pack_sequences(padidx, seq_len, truncate=False, carry_over=True, floatX='float32', dtype='int64'):
+    # Concatenate several records into each row of a (seq_len, rows) matrix.
+    # With carry_over, a record that does not fit continues on the next row;
+    # otherwise it starts a new row, and records longer than seq_len are cut.
+    # truncate cuts every record to seq_len tokens first.
+    # Returns (data, mask, reset) where reset marks the first token of every
+    # record, so that recurrent states can be restarted there.
+    def pack_sequences_core(batch):
+        tokens, lengths = concat_records(batch, dtype)
+        if truncate or not carry_over:
+            keep = numpy.arange(len(tokens)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths) < seq_len
+            tokens = tokens[keep]
+            lengths = numpy.minimum(lengths, seq_len)
+        starts = numpy.cumsum(lengths) - lengths
+
+        if carry_over:
+            # one continuous stream cut into rows
+            positions = numpy.arange(len(tokens))
+            record_positions = starts[lengths > 0]
+        else:
+            # greedy placement of whole records, row by row
+            record_positions = numpy.empty(len(lengths), dtype='int64')
+            row, used = 0, 0
+            for idx, length in enumerate(lengths):
+                if used + length > seq_len:
+                    row, used = row + 1, 0
+                record_positions[idx] = row * seq_len + used
+                used += length
+            positions = numpy.repeat(record_positions - starts, lengths) + numpy.arange(len(tokens))
+            record_positions = record_positions[lengths > 0]
+
+        num_rows = max(int(positions[-1]) // seq_len + 1, 1) if len(positions) > 0 else 1
+        data = numpy.empty((seq_len, num_rows), dtype=dtype)
+        data.fill(padidx)
+        data[positions % seq_len, positions // seq_len] = tokens
+        mask = numpy.zeros((seq_len, num_rows), dtype=floatX)
+        mask[positions % seq_len, positions // seq_len] = 1
+        reset = numpy.zeros((seq_len, num_rows), dtype=floatX)
+        reset[record_positions % seq_len, record_positions // seq_len] = 1
+
+        return data, mask, reset
+
+    return pack_sequences_core
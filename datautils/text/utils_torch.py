@@ -1,57 +1,115 @@
+import numpy
 import torch
+import itertools
+import multiprocessing
+from .utils import concat_records, scatter_positions, fill_mask
 
-def tensorize_binary(padidx, create_mask=False, reverse_seq=False, align_right=False, pin_memory=False):
-    def tensorize_binary_core(batch):
-        maxlen = max(map(len, batch))
-        data = torch.LongTensor(maxlen, len(batch)).fill_(padidx)
-        for idx in xrange(len(batch)):
-            if reverse_seq:
-                record = list(reversed(batch[idx]))
-            else:
-                record = batch[idx]
-            if align_right:
-                data[-len(record):, idx] = torch.LongTensor(record)
-            else:
-                data[:len(record), idx] = torch.LongTensor(record)
+class TensorRing(object):
+    # Recycles num_buffers flat tensors. Buffers are moved to shared memory
+    # (so that torch.multiprocessing hands them to another process by handle
+    # instead of pickling the data) or pinned, once when they are allocated.
+    # A tensor returned by get() is overwritten num_buffers calls later.
+    # Shared buffers are read by another process, so there get() waits for a
+    # free buffer: the consumer calls release() from any process once it is
+    # done with a tensor, in the order the tensors were handed out.
+    def __init__(self, num_buffers=2, shared=False, pin_memory=False):
+        if shared and pin_memory:
+            raise ValueError('a buffer can either be shared or pinned, not both')
+        self.buffers = [None] * num_buffers
+        self.pos = 0
+        self.shared = shared
+        self.pin_memory = pin_memory
+        self.free = multiprocessing.Semaphore(num_buffers) if shared else None
 
-        if create_mask:
-            mask = torch.ne(data, padidx).float()
-            if pin_memory:
-                return data.pin_memory(), mask.pin_memory()
-            else:
-                return data, mask
+    def release(self):
+        self.free.release()
+
+    def get(self, shape, tensor_type):
+        if self.free is not None:
+            self.free.acquire()
+        size = int(numpy.prod(shape))
+        buf = self.buffers[self.pos]
+        if buf is None or not isinstance(buf, tensor_type) or buf.numel() < size:
+            buf = tensor_type(size)
+            if self.shared:
+                buf.share_memory_()
+            if self.pin_memory:
+                buf = buf.pin_memory()
+            self.buffers[self.pos] = buf
+        self.pos = (self.pos + 1) % len(self.buffers)
+        return buf[:size].view(*shape)
+
+def _tensorize_core(tokens, lengths, padidx, create_mask, reverse_seq, align_right, pin_memory,
+                    data_ring, mask_ring):
+    maxlen, batch_size = int(lengths.max()), len(lengths)
+
+    # Fill through a numpy view of the tensor, which shares its storage
+    if data_ring is not None:
+        data = data_ring.get((maxlen, batch_size), torch.LongTensor)
+    else:
+        data = torch.LongTensor(maxlen, batch_size)
+    data_np = data.numpy()
+    data_np.fill(padidx)
+    data_np[scatter_positions(lengths, reverse_seq, align_right)] = tokens
+
+    if create_mask:
+        if mask_ring is not None:
+            mask = mask_ring.get((maxlen, batch_size), torch.FloatTensor)
         else:
-            if pin_memory:
-                return data.pin_memory()
-            else:
-                return data
-        
+            mask = torch.FloatTensor(maxlen, batch_size)
+        fill_mask(mask.numpy(), lengths, align_right)
+
+    # Ring buffers are pinned once at allocation, fresh tensors per batch
+    if pin_memory and data_ring is None:
+        data = data.pin_memory()
+        if create_mask:
+            mask = mask.pin_memory()
+
+    if create_mask:
+        return data, mask
+    else:
+        return data
+
+def _tensor_rings(num_buffers, create_mask, shared_memory, pin_memory):
+    if num_buffers == 0:
+        return None, None
+    data_ring = TensorRing(num_buffers, shared_memory, pin_memory)
+    mask_ring = TensorRing(num_buffers, shared_memory, pin_memory) if create_mask else None
+    return data_ring, mask_ring
+
+def _release_batch(data_ring, mask_ring):
+    # Frees the shared buffers of the oldest batch still held by the consumer
+    def release():
+        data_ring.release()
+        if mask_ring is not None:
+            mask_ring.release()
+    return release
+
+def tensorize_binary(padidx, create_mask=False, reverse_seq=False, align_right=False, pin_memory=False,
+                     num_buffers=0, shared_memory=False):
+    # num_buffers > 0 recycles that many output buffers, optionally in shared memory;
+    # shared buffers must be handed back with tensorize_binary_core.release()
+    data_ring, mask_ring = _tensor_rings(num_buffers, create_mask, shared_memory, pin_memory)
+
+    def tensorize_binary_core(batch):
+        tokens, lengths = concat_records(batch, 'int64')
+        return _tensorize_core(tokens, lengths, padidx, create_mask, reverse_seq, align_right,
+                               pin_memory, data_ring, mask_ring)
+
+    if num_buffers > 0 and shared_memory:
+        tensorize_binary_core.release = _release_batch(data_ring, mask_ring)
     return tensorize_binary_core
 
-def tensorize_string(vocab, create_mask=False, reverse_seq=False, align_right=False, pin_memory=False):
-    def tensorize_string_core(batch):
-        maxlen = max(map(len, batch))
-        data = torch.LongTensor(maxlen, len(batch)).fill_(vocab.pad)
-        for idx in xrange(len(batch)):
-            if reverse_seq:
-                record = map(vocab.encode, reversed(batch[idx]))
-            else:
-                record = map(vocab.encode, batch[idx])
-            if align_right:
-                data[-len(record):, idx] = torch.LongTensor(record)
-            else:
-                data[:len(record), idx] = torch.LongTensor(record)
+def tensorize_string(vocab, create_mask=False, reverse_seq=False, align_right=False, pin_memory=False,
+                     num_buffers=0, shared_memory=False):
+    data_ring, mask_ring = _tensor_rings(num_buffers, create_mask, shared_memory, pin_memory)
 
-        if create_mask:
-            mask = torch.ne(data, padidx).float()
-            if pin_memory:
-                return data.pin_memory(), mask.pin_memory()
-            else:
-                return data, mask
-        else:
-            if pin_memory:
-                return data.pin_memory()
-            else:
-                return data
+    def tensorize_string_core(batch):
+        lengths = numpy.fromiter((len(record) for record in batch), dtype='int64', count=len(batch))
+        tokens = vocab.encode_batch(list(itertools.chain.from_iterable(batch))).astype('int64', copy=False)
+        return _tensorize_core(tokens, lengths, vocab.pad, create_mask, reverse_seq, align_right,
+                               pin_memory, data_ring, mask_ring)
 
+    if num_buffers > 0 and shared_memory:
+        tensorize_string_core.release = _release_batch(data_ring, mask_ring)
     return tensorize_string_core
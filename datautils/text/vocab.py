@@ -1,4 +1,9 @@
+import os
+import numpy
 import collections
+from ..utils import fork_pool, worker_config
+from .utils import split_line, hash_symbol, hash_symbols
+from .datareader import glob_shards, open_text
 
 class Vocab(object):
     def __init__(self, counter, max_size=None, min_freq=1,
@@ -24,12 +29,268 @@ class Vocab(object):
         return self.sym2idx['<pad>']
 
     def encode(self, sym):
-        return self.sym2idx.get(sym, self.unk)
+        idx = self.sym2idx.get(sym)
+        return idx if idx is not None else self.unk
 
     def decode(self, idx):
         if idx >= len(self) or idx < 0:
             raise IndexError('index {} is out of range'.format(idx))
         return self.idx2sym[idx]
 
+    def encode_batch(self, symbols):
+        unk = self.unk
+        get = self.sym2idx.get
+        return numpy.fromiter((get(sym, unk) for sym in symbols), dtype='int64', count=len(symbols))
+
+    def decode_batch(self, indices):
+        return [self.decode(int(idx)) for idx in indices]
+
+    def freeze(self):
+        return FrozenVocab(self.idx2sym)
+
     def __len__(self):
-        return len(self.idx2sym)
\ No newline at end of file
+        return len(self.idx2sym)
+
+    #### Save / load the symbol table, one symbol per line in index order
+    def save(self, path):
+        with open(path, 'wb') as vocab_file:
+            for sym in self.idx2sym:
+                vocab_file.write(sym + b'\n')
+
+    @classmethod
+    def load(cls, path):
+        vocab = cls(collections.Counter(), special_syms=[])
+        with open(path, 'rb') as vocab_file:
+            for line in vocab_file:
+                sym = line.rstrip(b'\n')
+                vocab.sym2idx[sym] = len(vocab.idx2sym)
+                vocab.idx2sym.append(sym)
+        return vocab
+
+#### Compact, read-only vocabulary
+# Symbols live in one byte buffer with an offsets array (index order), and an
+# open addressing hash table maps 64-bit symbol hashes to indices. All arrays
+# can be saved and memory-mapped, so worker processes share one copy through
+# the page cache. Symbols are identified by their 64-bit hash, and colliding
+# symbols are rejected when the vocabulary is built.
+# Vectorized lookups only pay off on large batches, so encode_batch looks up
+# small ones (e.g. per-record binarize) symbol by symbol, through a dict of
+# the first cache_size symbols it has seen. For whole buffers, binarize_buffer
+# and encode_tokens hash the token spans directly and are the fastest path.
+class FrozenVocab(object):
+    # batches up to this size are looked up symbol by symbol
+    cache_batch = 1024
+
+    def __init__(self, symbols=None, arrays=None, cache_size=65536):
+        self.cache_size = cache_size
+        self.cache = {}
+        if arrays is not None:
+            self.sym_buffer, self.sym_offsets, self.sym_hashes, self.table = arrays
+        else:
+            self.build(symbols)
+        self.table_mask = len(self.table) - 1
+        self.unk_idx = self.lookup(b'<unk>')
+        self.pad_idx = self.lookup(b'<pad>')
+
+    def build(self, symbols):
+        symbols = list(symbols)
+        lengths = numpy.fromiter((len(sym) for sym in symbols), dtype='int64', count=len(symbols))
+        self.sym_offsets = numpy.concatenate([[0], numpy.cumsum(lengths)]).astype('int64')
+        self.sym_buffer = numpy.frombuffer(b''.join(symbols), dtype=numpy.uint8)
+        self.sym_hashes = hash_symbols(symbols)
+        if len(numpy.unique(self.sym_hashes)) != len(symbols):
+            raise ValueError('duplicate symbols or 64-bit hash collision in the vocabulary')
+
+        # power of two table with load factor <= 0.5
+        table_size = 1
+        while table_size < 2 * max(len(symbols), 1):
+            table_size *= 2
+        self.table = numpy.empty(table_size, dtype='int64')
+        self.table.fill(-1)
+        mask = numpy.uint64(table_size - 1)
+        for idx, sym_hash in enumerate(self.sym_hashes):
+            slot = int(sym_hash & mask)
+            while self.table[slot] >= 0:
+                slot = (slot + 1) & (table_size - 1)
+            self.table[slot] = idx
+
+    def lookup_hashes(self, hashes):
+        # Vectorized linear probing, -1 for missing symbols
+        result = numpy.empty(len(hashes), dtype='int64')
+        result.fill(-1)
+        pending = numpy.arange(len(hashes))
+        slots = (hashes & numpy.uint64(self.table_mask)).astype('int64')
+        while len(pending) > 0:
+            cands = self.table[slots]
+            filled = cands >= 0
+            found = filled.copy()
+            found[filled] = self.sym_hashes[cands[filled]] == hashes[pending[filled]]
+            result[pending[found]] = cands[found]
+            # continue probing where the slot holds another symbol
+            probe = filled & ~found
+            pending = pending[probe]
+            slots = (slots[probe] + 1) & self.table_mask
+        return result
+
+    def lookup(self, sym):
+        # the same probing on Python ints, -1 for a missing symbol
+        sym_hash = hash_symbol(sym)
+        slot = sym_hash & self.table_mask
+        while True:
+            idx = int(self.table[slot])
+            if idx < 0 or int(self.sym_hashes[idx]) == sym_hash:
+                return idx
+            slot = (slot + 1) & self.table_mask
+
+    @property
+    def unk(self):
+        return self.unk_idx
+
+    @property
+    def pad(self):
+        return self.pad_idx
+
+    def encode(self, sym):
+        idx = self.lookup(sym)
+        return idx if idx >= 0 else self.unk_idx
+
+    def encode_hashes(self, hashes):
+        indices = self.lookup_hashes(hashes)
+        indices[indices < 0] = self.unk_idx
+        return indices
+
+    def encode_batch(self, symbols):
+        if len(symbols) > self.cache_batch:
+            return self.encode_hashes(hash_symbols(symbols))
+
+        cache = self.cache
+        indices = []
+        for sym in symbols:
+            idx = cache.get(sym)
+            if idx is None:
+                idx = self.encode(sym)
+                if len(cache) < self.cache_size:
+                    cache[sym] = idx
+            indices.append(idx)
+        return numpy.array(indices, dtype='int64')
+
+    def decode(self, idx):
+        if idx >= len(self) or idx < 0:
+            raise IndexError('index {} is out of range'.format(idx))
+        return self.sym_buffer[self.sym_offsets[idx]:self.sym_offsets[idx+1]].tobytes()
+
+    def decode_batch(self, indices):
+        return [self.decode(int(idx)) for idx in indices]
+
+    def __len__(self):
+        return len(self.sym_hashes)
+
+    #### Save / memory-map as <prefix>.{buffer,offsets,hashes,table}.npy
+    _ARRAY_NAMES = ('buffer', 'offsets', 'hashes', 'table')
+
+    def save(self, prefix):
+        arrays = (self.sym_buffer, self.sym_offsets, self.sym_hashes, self.table)
+        for name, array in zip(self._ARRAY_NAMES, arrays):
+            numpy.save('{}.{}.npy'.format(prefix, name), array)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r', cache_size=65536):
+        arrays = tuple(numpy.load('{}.{}.npy'.format(prefix, name), mmap_mode=mmap_mode)
+                       for name in cls._ARRAY_NAMES)
+        return cls(arrays=arrays, cache_size=cache_size)
+
+#### Dictionary-free vocabulary
+# Symbols are mapped through the stable 64-bit FNV-1a hash into num_buckets
+# ids placed after the special symbols. Memory is constant and different
+# symbols may share an id.
+class HashedVocab(object):
+    def __init__(self, num_buckets, special_syms=[b'<unk>', b'<pad>']):
+        self.num_buckets = num_buckets
+        self.special_syms = list(special_syms)
+        self.special_hashes = hash_symbols(self.special_syms)
+
+    @property
+    def unk(self):
+        return self.special_syms.index(b'<unk>')
+
+    @property
+    def pad(self):
+        return self.special_syms.index(b'<pad>')
+
+    def encode_hashes(self, hashes):
+        indices = (hashes % numpy.uint64(self.num_buckets)).astype('int64') + len(self.special_syms)
+        for idx, special_hash in enumerate(self.special_hashes):
+            indices[hashes == special_hash] = idx
+        return indices
+
+    def encode_batch(self, symbols):
+        return self.encode_hashes(hash_symbols(symbols))
+
+    def encode(self, sym):
+        return int(self.encode_batch([sym])[0])
+
+    def decode(self, idx):
+        # Buckets cannot be inverted, they decode to a placeholder symbol
+        if idx >= len(self) or idx < 0:
+            raise IndexError('index {} is out of range'.format(idx))
+        if idx < len(self.special_syms):
+            return self.special_syms[idx]
+        return '<bucket:{}>'.format(idx - len(self.special_syms)).encode()
+
+    def decode_batch(self, indices):
+        return [self.decode(int(idx)) for idx in indices]
+
+    def __len__(self):
+        return len(self.special_syms) + self.num_buckets
+
+#### Parallel vocabulary building over sharded corpora
+def prune_counter(counter, capacity):
+    # Misra-Gries style pruning: subtract the (capacity+1)-th largest count
+    # and drop the non-positive entries. The result is a mergeable summary
+    # that keeps every symbol whose frequency exceeds total / capacity.
+    if len(counter) <= capacity:
+        return counter
+    threshold = counter.most_common(capacity + 1)[-1][1]
+    return collections.Counter({sym: freq - threshold for sym, freq in counter.items() if freq > threshold})
+
+# The tokenizer is handed to the workers through fork_pool, so closures work
+def _count_shard(data_path):
+    tokenize, sketch_size = worker_config()
+    counter = collections.Counter()
+    with open_text(data_path) as data_file:
+        for line in data_file:
+            counter.update(tokenize(line))
+            # bounded memory: prune in batches once twice over capacity
+            if sketch_size is not None and len(counter) > 2 * sketch_size:
+                counter = prune_counter(counter, sketch_size)
+    return counter
+
+def count_symbols(data_pattern, tokenize=split_line, num_workers=None, min_freq=1, top_k=None,
+                  sketch_size=None):
+    # Count the shards matching data_pattern* in a process pool and merge the
+    # partial counts. With sketch_size, every partial count is an approximate
+    # heavy-hitter summary of at most sketch_size symbols.
+    path_list = glob_shards(data_pattern)
+    with fork_pool(num_workers, (tokenize, sketch_size)) as pool:
+        counter = collections.Counter()
+        # merge in shard order: ties in most_common and the pruned summary
+        # depend on the merge order
+        for shard_counter in pool.imap(_count_shard, path_list):
+            counter.update(shard_counter)
+            if sketch_size is not None:
+                counter = prune_counter(counter, sketch_size)
+
+    if min_freq > 1:
+        counter = collections.Counter({sym: freq for sym, freq in counter.items() if freq >= min_freq})
+    if top_k is not None:
+        counter = collections.Counter(dict(counter.most_common(top_k)))
+    return counter
+
+def build_vocab(data_pattern, vocab_path, max_size=None, min_freq=1, **kwargs):
+    # Load the saved vocabulary if there is one, otherwise count and save it
+    if os.path.exists(vocab_path):
+        return Vocab.load(vocab_path)
+    counter = count_symbols(data_pattern, min_freq=min_freq, top_k=max_size, **kwargs)
+    vocab = Vocab(counter, max_size, min_freq)
+    vocab.save(vocab_path)
+    return vocab
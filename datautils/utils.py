@@ -0,0 +1,46 @@
+import pickle
+import contextlib
+import multiprocessing
+try:
+    # registers the shared memory reductions of e.g. torch tensors
+    from multiprocessing.reduction import ForkingPickler
+    _dumps = lambda obj: bytes(ForkingPickler.dumps(obj))
+except (ImportError, AttributeError):
+    _dumps = lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+#### Process pools of the prefetching modes
+# The per-pool config (usually closures, which cannot be pickled, or shared
+# buffers) is handed to the workers once through the pool initializer
+# (inherited on fork) and read back in the workers with worker_config()
+_worker_config = None
+
+def _init_worker(config):
+    global _worker_config
+    _worker_config = config
+
+def worker_config():
+    return _worker_config
+
+def prefetch_depth(num_prefetch, num_workers):
+    # default number of tasks in flight: two per worker
+    return num_prefetch if num_prefetch else max(2 * num_workers, 1)
+
+@contextlib.contextmanager
+def fork_pool(num_workers, config):
+    pool = multiprocessing.Pool(num_workers, _init_worker, (config,))
+    try:
+        yield pool
+        pool.close()
+    finally:
+        # also reached when the consumer stops early or raises
+        pool.terminate()
+        pool.join()
+
+def dump_result(obj):
+    # Pickle a worker result right away instead of when the pool returns it,
+    # so that recycled output buffers are copied before they are reused.
+    # Shared memory tensors still go by handle.
+    return _dumps(obj)
+
+def load_result(data):
+    return pickle.loads(data)
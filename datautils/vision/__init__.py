@@ -1,2 +1,14 @@
 from .data_iterator import *
 from .datasets import *
+from .augment import *
+
+try:
+    import PIL
+    pil_support = True
+except ImportError:
+    import warnings
+    warnings.warn('Fail to import PIL. No image file support')
+    pil_support = False
+
+if pil_support:
+    from .datareader import *
@@ -0,0 +1,113 @@
+import numpy as np
+
+"""Seeded, vectorized augmentations of image batches
+
+Usage:
+    augment = Augment(padding=4, flip=True, scale=1./255, mean=[...], std=[...],
+                      image_shape=(3, 32, 32))
+    out = augment(batch, np.random.RandomState(seed))
+
+Notes:
+    - Batches are NCHW by default, or NHWC with data_format='NHWC'
+    - All randomness comes from the rng argument, so a batch and a seed
+      always give the same result (also in worker processes)
+"""
+
+def _axes(data_format):
+    # (channel, height, width) axes of a batch
+    if data_format == 'NCHW':
+        return 1, 2, 3
+    elif data_format == 'NHWC':
+        return 3, 1, 2
+    else:
+        raise ValueError('unknown data_format {}'.format(data_format))
+
+def _hw_index(sel, rows, cols, data_format):
+    if data_format == 'NCHW':
+        return (sel, slice(None), rows, cols)
+    else:
+        return (sel, rows, cols, slice(None))
+
+def random_crop(batch, padding, rng, out=None, data_format='NCHW'):
+    """Crop every image at a random offset of its zero-padded version
+
+    The output keeps the image size. Images sharing an offset are copied
+    together, so there are at most (2 * padding + 1) ** 2 copies per batch.
+    """
+    _, h_axis, w_axis = _axes(data_format)
+    height, width = batch.shape[h_axis], batch.shape[w_axis]
+    if out is None:
+        out = np.empty_like(batch)
+    out.fill(0)
+
+    num_offsets = 2 * padding + 1
+    offsets = rng.randint(num_offsets * num_offsets, size=len(batch))
+    for offset in np.unique(offsets):
+        sel = np.nonzero(offsets == offset)[0]
+        dy, dx = offset // num_offsets - padding, offset % num_offsets - padding
+        out_rows = slice(max(0, -dy), min(height, height - dy))
+        out_cols = slice(max(0, -dx), min(width, width - dx))
+        in_rows = slice(max(0, dy), min(height, height + dy))
+        in_cols = slice(max(0, dx), min(width, width + dx))
+        out[_hw_index(sel, out_rows, out_cols, data_format)] = \
+            batch[_hw_index(sel, in_rows, in_cols, data_format)]
+
+    return out
+
+def random_flip(batch, rng, data_format='NCHW'):
+    """Flip half of the images horizontally, in place"""
+    sel = np.nonzero(rng.rand(len(batch)) < 0.5)[0]
+    flipped = _hw_index(sel, slice(None), slice(None, None, -1), data_format)
+    batch[_hw_index(sel, slice(None), slice(None), data_format)] = batch[flipped]
+    return batch
+
+def normalize(batch, scale=1., mean=None, std=None, data_format='NCHW'):
+    """Per-channel (batch * scale - mean) / std, in place"""
+    c_axis, _, _ = _axes(data_format)
+    shape = [1] * batch.ndim
+    shape[c_axis] = -1
+    if scale != 1.:
+        batch *= scale
+    if mean is not None:
+        batch -= np.asarray(mean, dtype=batch.dtype).reshape(shape)
+    if std is not None:
+        batch /= np.asarray(std, dtype=batch.dtype).reshape(shape)
+    return batch
+
+class Augment(object):
+    """Crop with padding, horizontal flip and per-channel normalization
+
+    Converts a batch to dtype and applies the augmentations in order. Flat
+    batches (e.g. cifar10 rows) are viewed as image_shape first.
+    """
+    def __init__(self, padding=0, flip=False, scale=1., mean=None, std=None,
+                 dtype='float32', data_format='NCHW', image_shape=None):
+        _axes(data_format)
+        self.padding = padding
+        self.flip = flip
+        self.scale = scale
+        self.mean = mean
+        self.std = std
+        self.dtype = np.dtype(dtype)
+        self.data_format = data_format
+        self.image_shape = tuple(image_shape) if image_shape is not None else None
+
+    def out_shape(self, shape):
+        if self.image_shape is not None:
+            return (shape[0],) + self.image_shape
+        return tuple(shape)
+
+    def __call__(self, batch, rng, out=None):
+        batch = batch.reshape(self.out_shape(batch.shape))
+        if out is None:
+            out = np.empty(batch.shape, dtype=self.dtype)
+
+        if self.padding > 0:
+            random_crop(batch, self.padding, rng, out, self.data_format)
+        else:
+            out[...] = batch
+        if self.flip:
+            random_flip(out, rng, self.data_format)
+        normalize(out, self.scale, self.mean, self.std, self.data_format)
+
+        return out
@@ -1,14 +1,77 @@
 import numpy as np
+import random
+import itertools
+import collections
+import multiprocessing
+from .datasets import LazyArray
+from ..utils import fork_pool, worker_config, prefetch_depth
+
+class BatchBuffer(object):
+    """Reusable output buffers for the minibatches of one ndarray
+
+    Unshuffled batches are slice views of the data; shuffled batches are
+    gathered into a preallocated buffer. With dtype given, batches are
+    converted as data * scale + shift into a second preallocated buffer.
+    A LazyArray is gathered from its raw rows and then transformed, which
+    already converts, so dtype must be None there. Returned batches are
+    overwritten by the next call.
+    """
+    def __init__(self, data, batch_size, dtype=None, scale=1., shift=0.):
+        self.transform = None
+        if isinstance(data, LazyArray):
+            if dtype is not None:
+                raise ValueError('a LazyArray is converted by its transform, dtype must be None')
+            self.transform = data.transform
+            data = data.data
+        self.data = data
+        shape = (batch_size,) + data.shape[1:]
+        self.gather_buf = np.empty(shape, dtype=data.dtype)
+        self.convert_buf = np.empty(shape, dtype=dtype) if dtype is not None else None
+        self.scale = scale
+        self.shift = shift
+
+    def convert(self, batch):
+        if self.transform is not None:
+            return self.transform(batch)
+        if self.convert_buf is None:
+            return batch
+        out = self.convert_buf[:len(batch)]
+        np.multiply(batch, self.scale, out=out, casting='unsafe')
+        if self.shift != 0:
+            np.add(out, self.shift, out=out, casting='unsafe')
+        return out
+
+    def slice(self, start, end):
+        return self.convert(self.data[start:end])
+
+    def take(self, indices):
+        out = self.gather_buf[:len(indices)]
+        np.take(self.data, indices, axis=0, out=out)
+        return self.convert(out)
+
+def _next_batch(buffers, data_indices, idx, batch_size, shuffle):
+    if shuffle:
+        chosen_indices = data_indices[idx:idx+batch_size]
+        return tuple(buf.take(chosen_indices) for buf in buffers)
+    else:
+        return tuple(buf.slice(idx, idx+batch_size) for buf in buffers)
 
 class FixDimIterator(object):
     def __init__(self, data, batch_size, **kwargs):
         super(FixDimIterator, self).__init__()
         self.data = data
-        
+
         self.num_data = data.shape[0]
 
         self.shuffle = kwargs.get('shuffle', False)
-    
+
+        # zero-copy mode: slice views / preallocated gather buffers, with an
+        # optional fused conversion to dtype as data * scale + shift
+        self.reuse_buffers = kwargs.get('reuse_buffers', False)
+        self.dtype = kwargs.get('dtype', None)
+        self.scale = kwargs.get('scale', 1.)
+        self.shift = kwargs.get('shift', 0.)
+
         self.set_batchsize(batch_size)
         self.reset()
 
@@ -19,6 +82,9 @@ class FixDimIterator(object):
 
         self.batch_size = batch_size
 
+        if self.reuse_buffers:
+            self.buffers = (BatchBuffer(self.data, batch_size, self.dtype, self.scale, self.shift),)
+
     def __iter__(self):
         return self
 
@@ -35,15 +101,18 @@ class FixDimIterator(object):
             raise StopIteration
 
         idx = self.batch_idx * self.batch_size
-        chosen_indices = self.data_indices[idx:idx+self.batch_size]
         self.batch_idx += 1
 
+        if self.reuse_buffers:
+            return _next_batch(self.buffers, self.data_indices, idx, self.batch_size, self.shuffle)[0]
+
+        chosen_indices = self.data_indices[idx:idx+self.batch_size]
         return self.data[chosen_indices]
 
-    
+
 class MultiFixDimIterator(object):
     """Iterate multiple ndarrays (e.g. images and labels) and return tuples of minibatches"""
-    
+
     def __init__(self, *data, **kwargs):
         super(MultiFixDimIterator, self).__init__()
 
@@ -55,13 +124,23 @@ class MultiFixDimIterator(object):
         self.batch_size = kwargs.get('batch_size', 100)
 
         self.shuffle = kwargs.get('shuffle', False)
-        
+
         self.n_batches = self.num_data / self.batch_size
         if self.num_data % self.batch_size != 0:
             self.n_batches += 1
 
+        # zero-copy mode, see FixDimIterator; dtypes, scales and shifts are
+        # given per ndarray (None keeps the native dtype, e.g. for labels)
+        self.reuse_buffers = kwargs.get('reuse_buffers', False)
+        if self.reuse_buffers:
+            dtypes = kwargs.get('dtypes', [None] * len(data))
+            scales = kwargs.get('scales', [1.] * len(data))
+            shifts = kwargs.get('shifts', [0.] * len(data))
+            self.buffers = tuple(BatchBuffer(d, self.batch_size, dtype, scale, shift)
+                                 for d, dtype, scale, shift in zip(data, dtypes, scales, shifts))
+
         self.reset()
-    
+
     def __iter__(self):
         return self
 
@@ -78,7 +157,134 @@ class MultiFixDimIterator(object):
             raise StopIteration
 
         idx = self.batch_idx * self.batch_size
-        chosen_indices = self.data_indices[idx:idx+self.batch_size]
         self.batch_idx += 1
 
+        if self.reuse_buffers:
+            return _next_batch(self.buffers, self.data_indices, idx, self.batch_size, self.shuffle)
+
+        chosen_indices = self.data_indices[idx:idx+self.batch_size]
         return tuple(data[chosen_indices] for data in self.data)
+
+
+def _slot_array(shape, dtype, shared):
+    # Shared slots live in anonymous shared memory, so worker processes
+    # forked after the allocation write straight into the parent's arrays
+    if not shared:
+        return np.empty(shape, dtype=dtype)
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = multiprocessing.RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+def _row_spec(data):
+    # (row shape, dtype) of the batches of data; a LazyArray is probed on its
+    # first row since its transform may change both
+    if isinstance(data, LazyArray):
+        row = data[:1]
+        return row.shape[1:], row.dtype
+    return data.shape[1:], data.dtype
+
+def _fill_slot(data, slots, augment, slot_idx, indices, seed):
+    # gather the batch into the slot inputs, then augment the first ndarray
+    inputs, output = slots[slot_idx]
+    num = len(indices)
+    for d, buf in zip(data, inputs):
+        if isinstance(d, LazyArray):
+            # raw rows are gathered, transformed and then copied into the slot
+            buf[:num] = d.transform(np.take(d.data, indices, axis=0))
+        else:
+            np.take(d, indices, axis=0, out=buf[:num])
+    if augment is not None:
+        augment(inputs[0][:num], np.random.RandomState(seed), out=output[:num])
+    return num
+
+#### Worker side of PrefetchIterator, see datautils.utils.fork_pool
+# Only indices and seeds are sent per batch, the data and slots are in the config
+def _fill_slot_worker(slot_idx, indices, seed):
+    return _fill_slot(slot_idx=slot_idx, indices=indices, seed=seed, **worker_config())
+
+class PrefetchIterator(object):
+    """Gather and augment the minibatches of a FixDimIterator or MultiFixDimIterator in worker processes
+
+    Follows the epoch order of the wrapped iterator and keeps num_prefetch
+    batches in flight. Each batch is gathered into a shared memory slot and
+    its first ndarray is transformed by augment (e.g. an Augment), seeded per
+    batch from seed. Iterating yields one epoch; a returned batch is
+    overwritten after the next one is requested. num_workers=0 does the same
+    work on the calling thread.
+    """
+    def __init__(self, iterator, augment=None, num_workers=0, num_prefetch=None, seed=None):
+        self.iterator     = iterator
+        self.multi        = isinstance(iterator, MultiFixDimIterator)
+        self.data         = iterator.data if self.multi else (iterator.data,)
+        self.augment      = augment
+        self.num_workers  = num_workers
+        self.num_prefetch = prefetch_depth(num_prefetch, num_workers)
+        self.rng          = random.Random(seed)
+        self.slots        = None
+
+    def alloc_slots(self):
+        # one slot per batch in flight, plus the one held by the consumer
+        shared = self.num_workers > 0
+        num_slots = self.num_prefetch + 1 if shared else 1
+        batch_size = self.iterator.batch_size
+        specs = [_row_spec(d) for d in self.data]
+        self.slots = []
+        for _ in range(num_slots):
+            inputs = tuple(_slot_array((batch_size,) + shape, dtype, shared) for shape, dtype in specs)
+            output = None
+            if self.augment is not None:
+                output = _slot_array(self.augment.out_shape(inputs[0].shape), self.augment.dtype, shared)
+            self.slots.append((inputs, output))
+
+    def begin_epoch(self):
+        self.iterator.reset()
+        # (re)allocate on the first epoch and after set_batchsize
+        if self.slots is None or len(self.slots[0][0][0]) != self.iterator.batch_size:
+            self.alloc_slots()
+
+    def epoch_tasks(self):
+        it = self.iterator
+        for batch_idx in range(it.n_batches):
+            indices = it.data_indices[batch_idx*it.batch_size:(batch_idx+1)*it.batch_size]
+            yield batch_idx % len(self.slots), indices, self.rng.getrandbits(32)
+
+    def get_batch(self, slot_idx, num):
+        inputs, output = self.slots[slot_idx]
+        first = output[:num] if output is not None else inputs[0][:num]
+        if not self.multi:
+            return first
+        return (first,) + tuple(buf[:num] for buf in inputs[1:])
+
+    def __iter__(self):
+        if self.num_workers > 0:
+            return self.iter_prefetch()
+        else:
+            return self.iter_serial()
+
+    def iter_serial(self):
+        self.begin_epoch()
+
+        for slot_idx, indices, seed in self.epoch_tasks():
+            num = _fill_slot(self.data, self.slots, self.augment, slot_idx, indices, seed)
+            yield self.get_batch(slot_idx, num)
+
+    def iter_prefetch(self):
+        self.begin_epoch()
+
+        config = dict(data=self.data, slots=self.slots, augment=self.augment)
+        tasks = self.epoch_tasks()
+        pending = collections.deque()
+        with fork_pool(self.num_workers, config) as pool:
+            while True:
+                # a slot is only refilled once the consumer has asked for the
+                # batch after it, since slots are used round-robin
+                for slot_idx, indices, seed in itertools.islice(tasks, self.num_prefetch - len(pending)):
+                    result = pool.apply_async(_fill_slot_worker, (slot_idx, indices, seed))
+                    pending.append((slot_idx, result))
+
+                if len(pending) == 0:
+                    break
+
+                slot_idx, result = pending.popleft()
+                yield self.get_batch(slot_idx, result.get())
@@ -0,0 +1,245 @@
+import os
+import io
+import mmap
+import json
+import random
+import numpy as np
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from PIL import Image
+
+"""Packed image records and a parallel decoding reader
+
+Usage:
+    pack_images(image_dir, output_prefix, image_size=(256, 256), encoded=False)
+    data = ImageRecords(output_prefix)
+    iterator = MultiFixDimIterator(data, data.labels, batch_size=256, shuffle=True)
+
+Layout:
+    - <prefix>.meta: json with the number of shards, the class names, whether
+      records are encoded files and the fixed image shape of raw records
+    - <prefix>-00000, ...: concatenated record bytes of every shard
+    - <shard>.idx.npy: int64 record offsets (one more than the records)
+    - <shard>.lbl.npy: int64 labels (-1 for unlabeled images)
+
+Notes:
+    - Encoded records keep the original file bytes and are decoded and resized
+      by the reader; raw records are decoded and resized to image_size once by
+      pack_images and stored as uint8 HWC pixels
+    - Images are converted to mode (RGB by default) and resized to
+      image_size (height, width) without keeping the aspect ratio
+"""
+
+_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.ppm', '.gif', '.tif', '.tiff', '.webp')
+
+def _shard_path(prefix, shard_idx):
+    return '{}-{:05d}'.format(prefix, shard_idx)
+
+def decode_image(data, image_size=None, mode='RGB'):
+    """Decode image file bytes into a uint8 HWC array, resized to image_size"""
+    image = Image.open(io.BytesIO(data)).convert(mode)
+    if image_size is not None and image.size != (image_size[1], image_size[0]):
+        image = image.resize((image_size[1], image_size[0]), Image.BILINEAR)
+    array = np.asarray(image, dtype=np.uint8)
+    if array.ndim == 2:
+        array = array[:, :, None]
+    return array
+
+def _decode_worker(args):
+    return decode_image(*args)
+
+def list_images(image_dir, extensions=_IMAGE_EXTENSIONS):
+    """(path, label) pairs of an image directory and the class names
+
+    Every subdirectory of image_dir is a class, labelled by its sorted
+    position. Images directly inside image_dir are unlabeled (-1).
+    """
+    def images_in(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if name.lower().endswith(extensions))
+
+    classes = sorted(name for name in os.listdir(image_dir)
+                     if os.path.isdir(os.path.join(image_dir, name)))
+    files = [(path, -1) for path in images_in(image_dir)]
+    for label, name in enumerate(classes):
+        for root, _, _ in sorted(os.walk(os.path.join(image_dir, name))):
+            files.extend((path, label) for path in images_in(root))
+    return files, classes
+
+def _read_record(args):
+    path, image_size, mode = args
+    with open(path, 'rb') as image_file:
+        data = image_file.read()
+    if image_size is None:
+        return data
+    return decode_image(data, image_size, mode).tobytes()
+
+def pack_images(image_dir, output_prefix, image_size=None, encoded=True, mode='RGB',
+                shard_records=10000, num_workers=8, files=None, seed=None):
+    """Pack the images of image_dir into sharded record files
+
+    files, a list of (path, label) pairs, replaces the directory scan of
+    list_images. With seed given, the images are shuffled before packing so
+    that every shard mixes the classes. Files are read (and decoded for raw
+    records) on num_workers threads.
+    """
+    classes = []
+    if files is None:
+        files, classes = list_images(image_dir)
+    files = list(files)
+    if seed is not None:
+        random.Random(seed).shuffle(files)
+
+    if not encoded and image_size is None:
+        raise ValueError('raw records need a fixed image_size')
+    num_channels = len(Image.new(mode, (1, 1)).getbands())
+    image_shape = [image_size[0], image_size[1], num_channels] if image_size is not None else None
+
+    pool = ThreadPool(num_workers) if num_workers > 0 else None
+    num_shards = 0
+    try:
+        for start in range(0, len(files), shard_records):
+            shard_files = files[start:start+shard_records]
+            args = [(path, None if encoded else image_size, mode) for path, _ in shard_files]
+            records = pool.imap(_read_record, args, 16) if pool is not None else map(_read_record, args)
+
+            shard_path = _shard_path(output_prefix, num_shards)
+            offsets = [0]
+            with open(shard_path, 'wb') as shard_file:
+                for record in records:
+                    shard_file.write(record)
+                    offsets.append(offsets[-1] + len(record))
+            np.save(shard_path + '.idx.npy', np.array(offsets, dtype='int64'))
+            np.save(shard_path + '.lbl.npy', np.array([label for _, label in shard_files], dtype='int64'))
+            num_shards += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    meta = {'num_shards': num_shards, 'classes': classes, 'encoded': encoded,
+            'mode': mode, 'image_shape': image_shape}
+    with open(output_prefix + '.meta', 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+class ImageRecords(object):
+    """Array-like random access to packed image records
+
+    Indexing with an int, a slice or an index array returns uint8 images of
+    shape (height, width, channels), decoded on num_workers threads (or
+    processes with use_processes=True, as the decoder may hold the GIL).
+    take(indices, axis=0, out=out) decodes into a given buffer, so the
+    reader works with reuse_buffers and PrefetchIterator as well; inside
+    PrefetchIterator workers, use threads or num_workers=0.
+    """
+    def __init__(self, data_prefix, image_size=None, num_workers=4, use_processes=False):
+        with open(data_prefix + '.meta', 'r') as meta_file:
+            meta = json.load(meta_file)
+        self.classes = meta['classes']
+        self.encoded = meta['encoded']
+        self.mode = str(meta['mode'])
+
+        if self.encoded:
+            if image_size is None:
+                raise ValueError('encoded records need an image_size to decode to')
+            num_channels = len(Image.new(self.mode, (1, 1)).getbands())
+            self.image_shape = (image_size[0], image_size[1], num_channels)
+        else:
+            self.image_shape = tuple(meta['image_shape'])
+        self.image_size = self.image_shape[:2]
+
+        self.data_files, self.data_mmaps, self.offsets, labels = [], [], [], []
+        for shard_idx in range(meta['num_shards']):
+            shard_path = _shard_path(data_prefix, shard_idx)
+            data_file = open(shard_path, 'rb')
+            self.data_files.append(data_file)
+            if os.path.getsize(shard_path) > 0:
+                self.data_mmaps.append(mmap.mmap(data_file.fileno(), 0, access = mmap.ACCESS_READ))
+            else:
+                self.data_mmaps.append(None)
+            self.offsets.append(np.load(shard_path + '.idx.npy', mmap_mode='r'))
+            labels.append(np.load(shard_path + '.lbl.npy'))
+        self.labels = np.concatenate(labels) if labels else np.zeros(0, dtype='int64')
+        # global index of the first record of every shard
+        self.shard_starts = np.cumsum([0] + [len(offsets) - 1 for offsets in self.offsets])
+
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+        self.pool = None
+        self.pool_pid = None
+
+    @property
+    def shape(self):
+        return (len(self),) + self.image_shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.uint8)
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def get_pool(self):
+        # a pool does not survive fork, so forked copies of the reader
+        # (e.g. in PrefetchIterator workers) start their own
+        if self.num_workers == 0:
+            return None
+        if self.pool is None or self.pool_pid != os.getpid():
+            if self.use_processes:
+                self.pool = multiprocessing.Pool(self.num_workers)
+            else:
+                self.pool = ThreadPool(self.num_workers)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def read_bytes(self, idx):
+        shard_idx = int(np.searchsorted(self.shard_starts, idx, side='right')) - 1
+        local_idx = idx - int(self.shard_starts[shard_idx])
+        offsets = self.offsets[shard_idx]
+        return self.data_mmaps[shard_idx][int(offsets[local_idx]):int(offsets[local_idx+1])]
+
+    def take(self, indices, axis=0, out=None, mode='raise'):
+        # Same signature as ndarray.take, which np.take calls: on a TypeError
+        # np.take would fall back to np.asarray(self) and decode everything
+        if axis != 0:
+            raise ValueError('ImageRecords only supports take along axis 0')
+        indices = np.asarray(indices, dtype='int64')
+        if mode == 'wrap':
+            indices = indices % len(self)
+        elif mode == 'clip':
+            indices = np.clip(indices, 0, len(self) - 1)
+        else:
+            if np.any((indices < -len(self)) | (indices >= len(self))):
+                raise IndexError('index out of range for {} records'.format(len(self)))
+            indices = np.where(indices < 0, indices + len(self), indices)
+        if out is None:
+            out = np.empty((len(indices),) + self.image_shape, dtype=np.uint8)
+
+        records = [self.read_bytes(int(idx)) for idx in indices]
+        if not self.encoded:
+            for i, record in enumerate(records):
+                out[i] = np.frombuffer(record, dtype=np.uint8).reshape(self.image_shape)
+            return out
+
+        args = [(record, self.image_size, self.mode) for record in records]
+        pool = self.get_pool()
+        images = pool.imap(_decode_worker, args, 4) if pool is not None else map(_decode_worker, args)
+        for i, image in enumerate(images):
+            out[i] = image
+        return out
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(np.arange(*index.indices(len(self))))
+        elif np.ndim(index) == 0:
+            return self.take([index])[0]
+        else:
+            return self.take(index)
+
+    def __del__(self):
+        if self.pool is not None and self.pool_pid == os.getpid():
+            self.pool.terminate()
+        for data_mmap in self.data_mmaps:
+            if data_mmap is not None:
+                data_mmap.close()
+        for data_file in self.data_files:
+            data_file.close()
@@ -10,81 +10,172 @@ Usage:
 
 Notes:
     - The preprocess only applies to data not the label
+    - The parsed arrays are cached as native dtype .npy files in data_dir
+      (disable with cache=False) and memory-mapped on later calls; the cache
+      is rebuilt when the size or mtime of the original files changes
+    - With lazy=True, the data is returned as a LazyArray that converts to
+      floatX and applies preprocess per indexed batch
 """
 
+class LazyArray(object):
+    """Array-like wrapper that applies transform to each indexed batch only"""
+    def __init__(self, data, transform):
+        self.data = data
+        self.transform = transform
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        return self.transform(self.data[index])
+
+    def subset(self, indices):
+        # Raw (native dtype) copy of the selected rows, still lazily transformed
+        return LazyArray(self.data[indices], self.transform)
+
+def _source_signature(data_dir, source_files):
+    # (name, size, mtime in microseconds) of the original files, or None
+    # when they are gone and only the cache is left
+    signature = []
+    for name in source_files:
+        path = os.path.join(data_dir, name)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        signature.append((name, stat.st_size, int(stat.st_mtime * 1e6)))
+    return repr(signature)
+
+def _save_atomic(path, array):
+    # Write to a temporary file first so that a crash never leaves a
+    # truncated file under the final name
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as tmp_file:
+        np.save(tmp_file, array)
+    os.rename(tmp_path, path)
+
+def _load_cached(data_dir, name, load_raw, source_files, cache=True):
+    # <name>.meta holds the signature of the source files and is written
+    # last, so the cache is rebuilt after a partial write or a source change
+    keys = ('trX', 'teX', 'trY', 'teY')
+    paths = [os.path.join(data_dir, '{}_{}.npy'.format(name, key)) for key in keys]
+    meta_path = os.path.join(data_dir, '{}.meta'.format(name))
+    signature = _source_signature(data_dir, source_files)
+    if cache and os.path.exists(meta_path) and all(os.path.exists(path) for path in paths):
+        with open(meta_path, 'r') as meta_file:
+            valid = signature is None or meta_file.read() == signature
+        if valid:
+            # copy-on-write maps stay writable without touching the cache
+            return tuple(np.load(path, mmap_mode='c') for path in paths)
+
+    arrays = load_raw()
+    if cache:
+        try:
+            for path, array in zip(paths, arrays):
+                _save_atomic(path, array)
+            tmp_path = '{}.{}.tmp'.format(meta_path, os.getpid())
+            with open(tmp_path, 'w') as meta_file:
+                meta_file.write(signature)
+            os.rename(tmp_path, meta_path)
+            return tuple(np.load(path, mmap_mode='c') for path in paths)
+        except (IOError, OSError):
+            pass
+    return arrays
+
+def _finalize(trX, teX, trY, teY, convert, **kwargs):
+    preprocess = kwargs.get('preprocess', False)
+    def transform(data):
+        data = convert(data)
+        if preprocess and callable(preprocess):
+            data = preprocess(data)
+        return data
+
+    if kwargs.get('lazy', False):
+        return LazyArray(trX, transform), LazyArray(teX, transform), trY, teY
+    return transform(trX), transform(teX), trY, teY
+
+def _to_float(**kwargs):
+    floatX = kwargs.get('floatX', float)
+    return lambda data: np.asarray(data).astype(floatX)
+
+def _shuffle_split(trX, trY, num_train):
+    if isinstance(trX, LazyArray):
+        # same permutation as skutils.shuffle with this random state
+        perm = np.random.RandomState(12345).permutation(len(trX))
+        return (trX.subset(perm[num_train:]), trY[perm[num_train:]],
+                trX.subset(perm[:num_train]), trY[perm[:num_train]])
+    else:
+        trX, trY = skutils.shuffle(trX, trY,
+                                   random_state=np.random.RandomState(12345))
+    return trX[num_train:], trY[num_train:], trX[:num_train], trY[:num_train]
+
 #### Download link: https://github.com/yburda/iwae/tree/master/datasets/OMNIGLOT
 def omniglot(data_dir, **kwargs):
     def reshape_data(data):
         return data.reshape((-1, 1, 28, 28), order='fortran')
-    omni_raw = scipy.io.loadmat(os.path.join(data_dir, 'chardata.mat'))
 
-    trX = reshape_data(omni_raw['data'].T.astype(float))
-    teX = reshape_data(omni_raw['testdata'].T.astype(float))
+    def load_raw():
+        omni_raw = scipy.io.loadmat(os.path.join(data_dir, 'chardata.mat'))
 
-    trY = omni_raw['targetchar'].flatten()
-    teY = omni_raw['testtargetchar'].flatten()
+        trX = reshape_data(omni_raw['data'].T)
+        teX = reshape_data(omni_raw['testdata'].T)
 
-    # There are totally 55 classes
-    trY[trY==55] = 0
-    teY[teY==55] = 0
+        trY = omni_raw['targetchar'].flatten()
+        teY = omni_raw['testtargetchar'].flatten()
 
-    preprocess = kwargs.get('preprocess', False)
-    if preprocess and callable(preprocess):
-        trX = preprocess(trX)
-        teX = preprocess(teX)
+        # There are totally 55 classes
+        trY[trY==55] = 0
+        teY[teY==55] = 0
+        return trX, teX, trY, teY
 
-    return trX, teX, trY, teY
+    trX, teX, trY, teY = _load_cached(data_dir, 'omniglot', load_raw, ['chardata.mat'], kwargs.get('cache', True))
+    return _finalize(trX, teX, trY, teY, _to_float(**kwargs), **kwargs)
 
 def omniglot_with_valid_set(data_dir, **kwargs):
     # 1345 data points are used for validation (following IWAE)
     trX, teX, trY, teY = omniglot(data_dir, **kwargs)
-    trX, trY = skutils.shuffle(trX, trY,
-                               random_state=np.random.RandomState(12345))
-    vaX = trX[-1345:]
-    vaY = trY[-1345:]
-    trX = trX[:-1345]
-    trY = trY[:-1345]
+    vaX, vaY, trX, trY = _shuffle_split(trX, trY, len(trX) - 1345)
 
     return trX, vaX, teX, trY, vaY, teY
 
 #### Download link: http://yann.lecun.com/exdb/mnist/
-def mnist(data_dir, **kwargs):
-    fd = open(os.path.join(data_dir,'train-images-idx3-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    trX = loaded[16:].reshape((60000,28*28)).astype(float)
+_MNIST_FILES = ['train-images-idx3-ubyte', 'train-labels-idx1-ubyte',
+                't10k-images-idx3-ubyte', 't10k-labels-idx1-ubyte']
 
-    fd = open(os.path.join(data_dir,'train-labels-idx1-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    trY = loaded[8:].reshape((60000))
+def mnist(data_dir, **kwargs):
+    def load_raw():
+        fd = open(os.path.join(data_dir,'train-images-idx3-ubyte'))
+        loaded = np.fromfile(file=fd,dtype=np.uint8)
+        trX = loaded[16:].reshape((60000,28*28))
 
-    fd = open(os.path.join(data_dir,'t10k-images-idx3-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    teX = loaded[16:].reshape((10000,28*28)).astype(float)
+        fd = open(os.path.join(data_dir,'train-labels-idx1-ubyte'))
+        loaded = np.fromfile(file=fd,dtype=np.uint8)
+        trY = loaded[8:].reshape((60000))
 
-    fd = open(os.path.join(data_dir,'t10k-labels-idx1-ubyte'))
-    loaded = np.fromfile(file=fd,dtype=np.uint8)
-    teY = loaded[8:].reshape((10000))
+        fd = open(os.path.join(data_dir,'t10k-images-idx3-ubyte'))
+        loaded = np.fromfile(file=fd,dtype=np.uint8)
+        teX = loaded[16:].reshape((10000,28*28))
 
-    preprocess = kwargs.get('preprocess', False)
-    if preprocess and callable(preprocess):
-        trX = preprocess(trX)
-        teX = preprocess(teX)
+        fd = open(os.path.join(data_dir,'t10k-labels-idx1-ubyte'))
+        loaded = np.fromfile(file=fd,dtype=np.uint8)
+        teY = loaded[8:].reshape((10000))
+        return trX, teX, trY, teY
 
-    return trX, teX, trY, teY 
+    trX, teX, trY, teY = _load_cached(data_dir, 'mnist', load_raw, _MNIST_FILES, kwargs.get('cache', True))
+    return _finalize(trX, teX, trY, teY, _to_float(**kwargs), **kwargs)
 
 def mnist_with_valid_set(data_dir, **kwargs):
     trX, teX, trY, teY = mnist(data_dir, **kwargs)
-
-    trX, trY = skutils.shuffle(trX, trY,
-                               random_state=np.random.RandomState(12345))
-    vaX = trX[50000:]
-    vaY = trY[50000:]
-    trX = trX[:50000]
-    trY = trY[:50000]
+    vaX, vaY, trX, trY = _shuffle_split(trX, trY, 50000)
 
     return trX, vaX, teX, trY, vaY, teY
 
 #### Download link: https://www.cs.toronto.edu/~kriz/cifar.html
+_CIFAR10_FILES = ['data_batch_{}'.format(k + 1) for k in range(5)] + ['test_batch']
+
 def cifar10(data_dir, **kwargs):
     # Cifar10 comes with 5 partitions
     def _load_batch_cifar10(data_dir, batch_name):
@@ -95,45 +186,44 @@ def cifar10(data_dir, **kwargs):
         labels = batch['labels']
         return data, labels
 
-    # train
-    trX, trY = [], []
-    for k in xrange(5):
-        x, t = _load_batch_cifar10(data_dir, 'data_batch_{}'.format(k + 1)) 
-        trX.append(x)
-        trY.append(t)
+    def load_raw():
+        # train
+        trX, trY = [], []
+        for k in xrange(5):
+            x, t = _load_batch_cifar10(data_dir, 'data_batch_{}'.format(k + 1)) 
+            trX.append(x)
+            trY.append(t)
 
-    trX = np.concatenate(trX)
-    trY = np.concatenate(trY)
+        trX = np.concatenate(trX)
+        trY = np.concatenate(trY)
 
-    # test
-    teX, teY = _load_batch_cifar10(data_dir, 'test_batch')
+        # test
+        teX, teY = _load_batch_cifar10(data_dir, 'test_batch')
+        return trX, teX, trY, np.asarray(teY)
 
-    preprocess = kwargs.get('preprocess', False)
-    if preprocess and callable(preprocess):
-        trX = preprocess(trX)
-        teX = preprocess(teX)
-    
-    return trX, teX, trY, teY
+    trX, teX, trY, teY = _load_cached(data_dir, 'cifar10', load_raw, _CIFAR10_FILES, kwargs.get('cache', True))
+    # cifar10 keeps its native dtype unless floatX is given
+    convert = _to_float(**kwargs) if 'floatX' in kwargs else np.asarray
+    return _finalize(trX, teX, trY, teY, convert, **kwargs)
 
 #### Download link: http://ufldl.stanford.edu/housenumbers/
 def svhn(data_dir, **kwargs):
     def _load_svhn_split(data_dir, split):
         path = os.path.join(data_dir, '{}_32x32.mat'.format(split))
         data = scipy.io.loadmat(path)
-        X = data['X'].transpose(3, 0, 1, 2).astype(float)
+        X = data['X'].transpose(3, 0, 1, 2)
         Y = data['y'].reshape((-1))
         Y[Y == 10] = 0
         return X, Y
 
-    trX, trY = _load_svhn_split(data_dir, 'train')
-    teX, teY = _load_svhn_split(data_dir, 'test')
+    def load_raw():
+        trX, trY = _load_svhn_split(data_dir, 'train')
+        teX, teY = _load_svhn_split(data_dir, 'test')
+        return trX, teX, trY, teY
 
-    preprocess = kwargs.get('preprocess', False)
-    if preprocess and callable(preprocess):
-        trX = preprocess(trX)
-        teX = preprocess(teX)
-    
-    return trX, teX, trY, teY
+    source_files = ['train_32x32.mat', 'test_32x32.mat']
+    trX, teX, trY, teY = _load_cached(data_dir, 'svhn', load_raw, source_files, kwargs.get('cache', True))
+    return _finalize(trX, teX, trY, teY, _to_float(**kwargs), **kwargs)
 
 # TODO:
 # 3D chairs: https://github.com/mathieuaubry/seeing3Dchairs/
@@ -0,0 +1,110 @@
+import os
+import random
+
+from datautils.text.utils import pack_binary
+from datautils.text.data_iterator import BucketIterator
+
+class ListDataset(object):
+    def __init__(self, records):
+        self.records = records
+
+    def reset(self, shuffle=False, rank=0, world_size=1, seed=None):
+        self.pos = 0
+
+    def next_record(self):
+        if self.pos >= len(self.records):
+            return None
+        self.pos += 1
+        return self.records[self.pos - 1]
+
+    def state_dict(self):
+        return {'pos': self.pos}
+
+    def load_state_dict(self, state):
+        self.pos = state['pos']
+
+def _batch_sums(num_buffers, **kwargs):
+    records = [[idx % 7 + 1] * (idx % 5 + 1) for idx in range(100)]
+    iterator = BucketIterator(ListDataset(records), batch_size=5, cache_size=40,
+                              pack_func=pack_binary(0, num_buffers=num_buffers), **kwargs)
+    # a consumer holding one batch at a time
+    return [int(batch.sum()) for batch in iterator]
+
+def test_recycled_buffers_are_not_overwritten_before_yield():
+    expected = _batch_sums(0)
+    assert _batch_sums(2) == expected
+    assert _batch_sums(2, shuffle=True, sort_func=len, seed=1) == _batch_sums(0, shuffle=True, sort_func=len, seed=1)
+
+def test_recycled_buffers_with_prefetching():
+    # workers pack a whole cache with a 2-buffer ring before returning it
+    assert _batch_sums(2, num_workers=2, seed=1) == _batch_sums(0, seed=1)
+
+def test_prefetch_packs_in_the_workers():
+    records = [[idx + 1] for idx in range(20)]
+    pack_pid = lambda batch: os.getpid()
+    iterator = BucketIterator(ListDataset(records), batch_size=5, cache_size=10,
+                              pack_func=pack_pid, num_workers=2)
+    pids = list(iterator)
+    assert len(pids) == 4 and os.getpid() not in pids
+
+    iterator = BucketIterator(ListDataset(records), batch_size=5, cache_size=10, pack_func=pack_pid)
+    assert list(iterator) == [os.getpid()] * 4
+
+def test_state_dict_before_first_iteration():
+    dataset = ListDataset([[1], [2]])
+    dataset.reset()
+    iterator = BucketIterator(dataset, batch_size=1)
+    state = iterator.state_dict()
+    assert state['end_of_epoch'] is False and state['ready_batches'] == []
+
+class BatchedListDataset(ListDataset):
+    def next_records(self, n):
+        records = self.records[self.pos:self.pos+n]
+        self.pos += len(records)
+        return records if records else None
+
+    def next_record(self):
+        raise AssertionError('read_cache should use next_records')
+
+def test_read_cache_uses_next_records():
+    records = [[idx + 1] for idx in range(12)]
+    iterator = BucketIterator(BatchedListDataset(records), batch_size=5, cache_size=8)
+    assert [len(batch) for batch in iterator] == [5, 3, 4]
+    assert [len(batch) for batch in iterator] == [5, 3, 4]
+
+def test_reader_seeds_differ_from_cache_seeds():
+    iterator = BucketIterator(ListDataset([[1]]), batch_size=1, seed=3)
+    assert iterator.rng.getrandbits(32) != iterator.data_rng.getrandbits(32)
+
+def test_seed_fixes_the_order_in_both_modes():
+    records = [[idx] * (idx % 6 + 1) for idx in range(60)]
+    def order(**kwargs):
+        iterator = BucketIterator(ListDataset(records), batch_size=4, cache_size=20, shuffle=True,
+                                  sort_func=len, seed=7, **kwargs)
+        return [[record[0] for record in batch] for batch in iterator]
+
+    random.seed(1)
+    serial = order()
+    random.seed(2)
+    assert order() == serial
+    assert order(num_workers=2) == serial
+
+def test_resume_leaves_the_global_rngs_alone():
+    records = [[idx] * (idx % 6 + 1) for idx in range(60)]
+    def make_iterator():
+        return BucketIterator(ListDataset(records), batch_size=4, cache_size=20, shuffle=True,
+                              sort_func=len, seed=7)
+
+    full = [[record[0] for record in batch] for batch in make_iterator()]
+
+    iterator = make_iterator()
+    batches = iter(iterator)
+    head = [[record[0] for record in next(batches)] for _ in range(3)]
+    state = iterator.state_dict()
+
+    random.seed(123)
+    restored = make_iterator()
+    restored.load_state_dict(state)
+    assert random.random() == random.Random(123).random()
+    tail = [[record[0] for record in batch] for batch in restored]
+    assert head + tail == full
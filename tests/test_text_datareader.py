@@ -0,0 +1,134 @@
+from datautils.text.datareader import SmallText, MultiShardText, StreamingText, ProcessedCache, \
+    InterleavedShardText, BinarizedText, binarize_corpus, epoch_shards
+from datautils.text.vocab import FrozenVocab
+from datautils.text.utils import split_line
+
+class CountingText(SmallText):
+    opened = []
+
+    def __init__(self, data_path):
+        CountingText.opened.append(data_path)
+        super(CountingText, self).__init__(data_path)
+
+class CountingMultiShardText(MultiShardText):
+    shard_class = CountingText
+
+def _write_shards(tmpdir):
+    for shard_idx in range(3):
+        lines = ['{}-{}\n'.format(shard_idx, line_idx) for line_idx in range(4)]
+        tmpdir.join('shard.{}'.format(shard_idx)).write(''.join(lines))
+    return str(tmpdir.join('shard.'))
+
+def _read_all(dataset):
+    records = []
+    while True:
+        record = dataset.next_record()
+        if record is None:
+            return records
+        records.append(record)
+
+def test_multi_shard_loads_every_shard_once(tmpdir):
+    data_pattern = _write_shards(tmpdir)
+    del CountingText.opened[:]
+
+    dataset = CountingMultiShardText(data_pattern, shuffle_shard=False)
+    dataset.reset()
+    assert CountingText.opened == []
+
+    assert len(_read_all(dataset)) == 12
+    assert sorted(CountingText.opened) == sorted(set(CountingText.opened))
+    assert len(CountingText.opened) == 3
+
+def test_multi_shard_state_before_first_record(tmpdir):
+    data_pattern = _write_shards(tmpdir)
+    dataset = CountingMultiShardText(data_pattern, shuffle_shard=False)
+    state = dataset.state_dict()
+
+    restored = CountingMultiShardText(data_pattern, shuffle_shard=False)
+    restored.load_state_dict(state)
+    assert len(_read_all(restored)) == 12
+
+def test_leftover_shards_are_split_across_ranks(tmpdir):
+    expected = []
+    for shard_idx in range(5):
+        lines = ['{}-{}\n'.format(shard_idx, line_idx) for line_idx in range(4)]
+        tmpdir.join('part.{}'.format(shard_idx)).write(''.join(lines))
+        expected.extend(lines)
+    data_pattern = str(tmpdir.join('part.'))
+
+    _, paths, partitions = epoch_shards(['a', 'b', 'c', 'd', 'e'], rank=1, world_size=2)
+    assert paths == ['c', 'd', 'e'] and partitions == [(0, 1), (0, 1), (1, 2)]
+
+    for make_reader in (lambda: MultiShardText(data_pattern, shuffle_shard=False),
+                        lambda: StreamingText(data_pattern)):
+        records = []
+        for rank in range(2):
+            dataset = make_reader()
+            dataset.reset(False, rank, 2)
+            records.extend(record.decode() for record in _read_all(dataset))
+        assert sorted(records) == sorted(expected)
+
+def test_processed_cache_shared_between_processes(tmpdir):
+    data_path = tmpdir.join('data.txt')
+    data_path.write(''.join('{}\n'.format(idx) for idx in range(6)))
+    cache_path = str(tmpdir.join('cache'))
+    processed = []
+
+    def process_func(record):
+        processed.append(record)
+        return record.upper()
+
+    # two ranks sharing cache_path: each record is processed only once
+    first = ProcessedCache(SmallText(str(data_path)), process_func, cache_path, 'upper')
+    second = ProcessedCache(SmallText(str(data_path)), process_func, cache_path, 'upper')
+    first_records = _read_all(first)
+    assert _read_all(second) == first_records
+    assert len(processed) == 6
+
+    third = ProcessedCache(SmallText(str(data_path)), process_func, cache_path, 'lower')
+    assert _read_all(third) == first_records
+    assert len(processed) == 12
+
+def test_interleaved_shards_resume_same_order(tmpdir):
+    data_pattern = _write_shards(tmpdir)
+
+    dataset = InterleavedShardText(data_pattern, num_open=2)
+    dataset.reset(True, seed=7)
+    head = [dataset.next_record() for _ in range(5)]
+    state = dataset.state_dict()
+    tail = _read_all(dataset)
+
+    seeded = InterleavedShardText(data_pattern, num_open=2)
+    seeded.reset(True, seed=7)
+    assert _read_all(seeded) == head + tail
+
+    restored = InterleavedShardText(data_pattern, num_open=2)
+    restored.load_state_dict(state)
+    assert _read_all(restored) == tail
+
+def test_multi_shard_close_stops_loader(tmpdir):
+    data_pattern = _write_shards(tmpdir)
+    dataset = MultiShardText(data_pattern, shuffle_shard=False)
+    dataset.next_record()
+    loader = dataset.shard_loader
+    assert loader.is_alive()
+
+    dataset.close()
+    assert dataset.shard_loader is None
+    assert not loader.is_alive()
+
+def test_binarize_corpus_matches_per_line_encoding(tmpdir):
+    lines = [b'a b c\n', b'\n', b'  b  d \n', b'c,a a\n', b'e']
+    data_path = tmpdir.join('data.txt')
+    data_path.write(b''.join(lines), mode='wb')
+    vocab = FrozenVocab([b'<unk>', b'<pad>', b'a', b'b', b'c', b'c,a'])
+    output_prefix = str(tmpdir.join('data'))
+
+    # the buffer path for split_line and the generic path for other tokenizers
+    for tokenize in (split_line, lambda line: line.strip().split(b',')):
+        binarize_corpus(str(data_path), vocab, output_prefix, tokenize, chunk_size=8)
+        expected = [[vocab.encode(sym) for sym in tokenize(line)] for line in lines]
+
+        dataset = BinarizedText(output_prefix)
+        assert [dataset.read_record(idx).tolist() for idx in range(len(dataset))] == expected
+        assert tmpdir.listdir(lambda path: path.basename.endswith('.tmp')) == []
@@ -0,0 +1,24 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from datautils.text.utils_torch import TensorRing, tensorize_binary
+
+def test_shared_ring_waits_for_release():
+    ring = TensorRing(2, shared=True)
+    first = ring.get((3, 2), torch.LongTensor)
+    ring.get((3, 2), torch.LongTensor)
+    # both buffers are held by the consumer
+    assert not ring.free.acquire(False)
+
+    first.fill_(7)
+    ring.release()
+    third = ring.get((3, 2), torch.LongTensor)
+    assert third.data_ptr() == first.data_ptr()
+
+def test_tensorize_release_frees_data_and_mask():
+    tensorize = tensorize_binary(0, create_mask=True, num_buffers=1, shared_memory=True)
+    data, mask = tensorize([[1, 2], [3]])
+    tensorize.release()
+    data, mask = tensorize([[4], [5, 6]])
+    assert data.numpy().tolist() == [[4, 5], [0, 6]]
@@ -0,0 +1,22 @@
+import numpy
+from datautils.text.vocab import FrozenVocab
+from datautils.text.utils import hash_symbol, hash_symbols
+
+def test_hash_symbol_matches_hash_symbols():
+    symbols = [b'', b'a', b'the', b'x' * 40, b'\xff\x00']
+    assert [hash_symbol(sym) for sym in symbols] == hash_symbols(symbols).tolist()
+
+def test_frozen_vocab_small_and_large_batches_agree():
+    symbols = [b'<unk>', b'<pad>'] + [str(idx).encode() for idx in range(2000)]
+    vocab = FrozenVocab(symbols, cache_size=100)
+    queries = [str(idx).encode() for idx in range(0, 4000, 3)]
+
+    large = vocab.encode_batch(queries)
+    assert len(queries) > vocab.cache_batch
+    small = numpy.concatenate([vocab.encode_batch(queries[start:start+25])
+                               for start in range(0, len(queries), 25)])
+    assert (large == small).all()
+    assert len(vocab.cache) == 100
+
+    expected = [int(sym) + 2 if int(sym) < 2000 else vocab.unk for sym in queries]
+    assert small.tolist() == expected
@@ -0,0 +1,32 @@
+import numpy as np
+
+from datautils.vision.datasets import LazyArray
+from datautils.vision.data_iterator import FixDimIterator, MultiFixDimIterator, PrefetchIterator
+
+def test_reuse_buffers_on_lazy_array():
+    raw = np.arange(10 * 4, dtype=np.uint8).reshape(10, 4)
+    lazy = LazyArray(raw, lambda data: data.astype('float32') / 255.)
+
+    for shuffle in (False, True):
+        iterator = MultiFixDimIterator(lazy, np.arange(10), batch_size=4, shuffle=shuffle,
+                                       reuse_buffers=True)
+        for batch, indices in iterator:
+            assert batch.dtype == np.float32
+            assert np.allclose(batch, raw[indices] / 255.)
+
+def test_reuse_buffers_converts_in_place():
+    raw = np.arange(10 * 4, dtype=np.uint8).reshape(10, 4)
+    iterator = FixDimIterator(raw, 4, shuffle=True, reuse_buffers=True,
+                              dtype='float32', scale=2., shift=-1.)
+    batches = [batch for batch in iterator]
+    assert batches[0].base is batches[1].base
+
+def test_prefetch_on_lazy_array():
+    raw = np.arange(10 * 4, dtype=np.uint8).reshape(10, 4)
+    lazy = LazyArray(raw, lambda data: data.astype('float32') / 255.)
+
+    for num_workers in (0, 2):
+        iterator = MultiFixDimIterator(lazy, np.arange(10), batch_size=4, shuffle=True)
+        for batch, indices in PrefetchIterator(iterator, num_workers=num_workers):
+            assert batch.dtype == np.float32
+            assert np.allclose(batch, raw[indices] / 255.)
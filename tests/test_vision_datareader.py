@@ -0,0 +1,47 @@
+import numpy as np
+from PIL import Image
+
+from datautils.vision import datareader
+from datautils.vision.datareader import pack_images, ImageRecords
+from datautils.vision.data_iterator import FixDimIterator, PrefetchIterator
+
+def _pack(tmpdir, num_images=14):
+    for idx in range(num_images):
+        class_dir = tmpdir.join('class{}'.format(idx % 2)).ensure(dir=True)
+        pixels = np.random.randint(0, 255, (10, 12, 3)).astype(np.uint8)
+        Image.fromarray(pixels).save(str(class_dir.join('{}.png'.format(idx))))
+    prefix = str(tmpdir.join('records'))
+    pack_images(str(tmpdir), prefix, shard_records=5, num_workers=0)
+    return ImageRecords(prefix, image_size=(8, 8), num_workers=0)
+
+def _count_decodes(monkeypatch):
+    calls = []
+    decode_worker = datareader._decode_worker
+    def counting_decode_worker(args):
+        calls.append(1)
+        return decode_worker(args)
+    monkeypatch.setattr(datareader, '_decode_worker', counting_decode_worker)
+    return calls
+
+def test_np_take_decodes_only_the_batch(tmpdir, monkeypatch):
+    records = _pack(tmpdir)
+    calls = _count_decodes(monkeypatch)
+
+    out = np.empty((3,) + records.image_shape, dtype=np.uint8)
+    np.take(records, [0, 5, 13], axis=0, out=out)
+
+    assert len(calls) == 3
+    assert np.array_equal(out, records[[0, 5, 13]])
+
+def test_iterators_decode_one_batch_per_batch(tmpdir, monkeypatch):
+    records = _pack(tmpdir)
+    calls = _count_decodes(monkeypatch)
+
+    iterator = FixDimIterator(records, 4, shuffle=True, reuse_buffers=True)
+    for batch in iterator:
+        assert len(calls) == len(batch)
+        del calls[:]
+
+    for batch in PrefetchIterator(FixDimIterator(records, 4, shuffle=True)):
+        assert len(calls) == len(batch)
+        del calls[:]
@@ -0,0 +1,36 @@
+import numpy as np
+
+from datautils.vision.datasets import _load_cached
+
+def _loader(tmpdir, calls):
+    def load_raw():
+        calls.append(1)
+        value = len(tmpdir.join('source').read())
+        return tuple(np.full(3, value, dtype='int64') for _ in range(4))
+    return lambda: _load_cached(str(tmpdir), 'toy', load_raw, ['source'])
+
+def test_cache_is_reused_and_rebuilt_when_the_source_changes(tmpdir):
+    tmpdir.join('source').write('ab')
+    calls = []
+    load = _loader(tmpdir, calls)
+
+    assert load()[0].tolist() == [2, 2, 2]
+    assert load()[0].tolist() == [2, 2, 2]
+    assert len(calls) == 1
+
+    tmpdir.join('source').write('abcd')
+    assert load()[0].tolist() == [4, 4, 4]
+    assert len(calls) == 2
+
+def test_partial_cache_is_rebuilt(tmpdir):
+    tmpdir.join('source').write('ab')
+    calls = []
+    load = _loader(tmpdir, calls)
+    load()
+
+    # a crash while writing leaves no meta file behind
+    tmpdir.join('toy.meta').remove()
+    tmpdir.join('toy_teY.npy').write('truncated')
+    assert load()[3].tolist() == [2, 2, 2]
+    assert len(calls) == 2
+    assert not [path for path in tmpdir.listdir() if path.ext == '.tmp']